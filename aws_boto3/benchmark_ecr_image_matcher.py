@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# Microbenchmark of the clean_ecr_images identifier matcher against the
+# previous regex alternation approach. No AWS calls are made.
+
+# Requirements:
+# BOTO3
+
+import os
+import re
+import sys
+import random
+import argparse
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# The ECR client is created at import time and only needs a region
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-central-1')
+from clean_ecr_images import build_matcher, match_image
+
+def random_digest():
+    return 'sha256:' + '%064x' % random.getrandbits(256)
+
+def generate_images(quantity, tags_per_image):
+    return [
+        {
+            'imageDigest': random_digest(),
+            'imageTags': [f'build-{i}-{t}' for t in range(tags_per_image)]
+        }
+        for i in range(quantity)
+    ]
+
+def generate_identifiers(images, quantity):
+    identifier = []
+    for i in range(quantity):
+        if i % 3 == 0:
+            identifier.append(random_digest())
+        elif i % 3 == 1:
+            identifier.append(random_digest()[:19])
+        else:
+            identifier.append(f'release-{i}')
+    # Make a part of the images match by tag, digest and digest prefix
+    for image in images[::10]:
+        identifier.append(image['imageTags'][0])
+    for image in images[1::10]:
+        identifier.append(image['imageDigest'])
+    for image in images[2::10]:
+        identifier.append(image['imageDigest'][:19])
+    return identifier
+
+def regex_match(images, identifier):
+    compiled_pattern = re.compile('|'.join(identifier))
+    return [
+        image for image in images
+        if re.match(compiled_pattern, image['imageDigest']) or \
+            any(map(lambda v: v in identifier, image['imageTags']))
+    ]
+
+def matcher_match(images, identifier):
+    matcher = build_matcher(identifier)
+    return [image for image in images if match_image(matcher, image)]
+
+def measure(function, images, identifier):
+    start = timer()
+    result = function(images, identifier)
+    return timer() - start, len(result)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='This script compares ECR image identifier matchers.')
+    parser.add_argument(
+        '-i', '--images',
+        help='Quantity of synthetic images.',
+        action="store", type=int, default=2000)
+    parser.add_argument(
+        '-n', '--identifiers',
+        help='Quantity of synthetic identifiers.',
+        action="store", type=int, default=10000)
+    parser.add_argument(
+        '-t', '--tags',
+        help='Quantity of tags per image.',
+        action="store", type=int, default=3)
+    args = parser.parse_args()
+
+    random.seed(0)
+    images = generate_images(args.images, args.tags)
+    identifier = generate_identifiers(images, args.identifiers)
+
+    regex_time, regex_matched = measure(regex_match, images, identifier)
+    matcher_time, matcher_matched = measure(matcher_match, images, identifier)
+
+    print(f"Images: {len(images)}, identifiers: {len(identifier)}")
+    print(f"{'Regex':<10} {regex_time:>10.4f}s {regex_matched:>8} matched")
+    print(f"{'Matcher':<10} {matcher_time:>10.4f}s {matcher_matched:>8} matched")
+    print(f"Speedup: {regex_time / matcher_time:.1f}x")
+
+if __name__ == '__main__':
+    sys.exit(main())
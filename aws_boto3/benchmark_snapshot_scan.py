@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# Benchmark of the clean_snapshots client paginator scan against the previous
+# boto3 resource collection scan. Both read the same synthetic
+# describe_snapshots pages from a stubbed client, no AWS calls are made.
+
+# Requirements:
+# BOTO3
+
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+from datetime import datetime, timezone, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# Clients are created at import time and only need a region
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-central-1')
+import boto3
+import clean_snapshots
+
+def stub_describe_snapshots(client, quantity):
+    start_time = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+    def make_api_call(operation_name, api_params):
+        if operation_name != 'DescribeSnapshots':
+            raise ValueError(f'Unexpected operation {operation_name}')
+        page_size = api_params.get('MaxResults') or 1000
+        start = int(api_params.get('NextToken') or 0)
+        end = min(quantity, start + page_size)
+        response = {'Snapshots': [
+            {
+                'SnapshotId': f'snap-{i:017x}',
+                'VolumeId': f'vol-{i % 5000:017x}',
+                'VolumeSize': 8 + i % 100,
+                'StartTime': start_time + timedelta(minutes=i),
+                'State': 'completed',
+                'Progress': '100%',
+                'OwnerId': '123456789012',
+                'Description': 'Created by CreateImage',
+                'Encrypted': False,
+                'StorageTier': 'standard',
+                'Tags': [{'Key': 'user:tag', 'Value': 'eks-core'}]
+            }
+            for i in range(start, end)
+        ]}
+        if end < quantity:
+            response['NextToken'] = str(end)
+        return response
+
+    client._make_api_call = make_api_call
+
+# The scan used before: resource collection and the age computed per item
+def resource_scan(ec2, snapshots_older_than_days):
+    snapshot_list = []
+    for snapshot in ec2.snapshots.filter(OwnerIds=['self']).page_size(1000):
+        now = datetime.date(datetime.now())
+        created_at = datetime.date(snapshot.start_time)
+        if abs((now - created_at).days) > snapshots_older_than_days:
+            snapshot_list.append(snapshot)
+    return snapshot_list
+
+def client_scan(snapshots_older_than_days):
+    snapshot_list = []
+    cutoff = clean_snapshots.get_cutoff(snapshots_older_than_days)
+    for snapshot in clean_snapshots.scan_snapshots():
+        if datetime.date(snapshot.start_time) < cutoff:
+            snapshot_list.append(snapshot)
+    return snapshot_list
+
+def measure(function, *args):
+    start = time.process_time()
+    result = function(*args)
+    cpu_time = time.process_time() - start
+    del result
+    tracemalloc.start()
+    result = function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return cpu_time, peak, len(result)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='This script compares EC2 Snapshot scan implementations.')
+    parser.add_argument(
+        '-n', '--snapshots',
+        help='Quantity of synthetic snapshots.',
+        action="store", type=int, default=200000)
+    args = parser.parse_args()
+
+    ec2 = boto3.resource('ec2')
+    stub_describe_snapshots(ec2.meta.client, args.snapshots)
+    stub_describe_snapshots(clean_snapshots.client, args.snapshots)
+
+    results = (
+        ('Resource', measure(resource_scan, ec2, 30)),
+        ('Client', measure(client_scan, 30)),
+    )
+    print(f"Snapshots: {args.snapshots}")
+    print(f"{'Scan':<10} {'CPU':>10} {'Peak memory':>14} {'Matched':>8}")
+    for name, (cpu_time, peak, matched) in results:
+        print(f"{name:<10} {cpu_time:>9.2f}s {peak / 2 ** 20:>11.1f}MiB \
+{matched:>8}")
+
+if __name__ == '__main__':
+    sys.exit(main())
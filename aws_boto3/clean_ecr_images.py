@@ -3,16 +3,47 @@
 # Requirements:
 # AWS CLI
 # BOTO3
+# NUMPY (only for --report and --keep-last)
 
 import boto3
 import re
 import argparse
 import sys
+import queue
+import threading
 from pprint import pprint
 from datetime import datetime
 from os.path import exists
+from concurrent.futures import (ThreadPoolExecutor, as_completed, wait,
+                                FIRST_COMPLETED)
+from botocore.config import Config
+from ecr_inventory_cache import add_cache_arguments, get_cache
+from fan_out import (add_target_arguments, get_targets, run_targets,
+                     exit_status)
 
-client = boto3.client('ecr')
+MAX_WORKERS = 10
+DELETE_BATCH_SIZE = 100
+# Matched images waiting for the deleter in --all-repos and --repo-pattern mode
+SWEEP_QUEUE_SIZE = 1000
+
+# One client is shared by the scan and the delete worker threads, so the
+# connection pool has to hold both thread pools. --workers is limited to
+# half of the pool.
+MAX_POOL_CONNECTIONS = 50
+MAX_WORKERS_LIMIT = MAX_POOL_CONNECTIONS // 2
+client = boto3.client('ecr',
+                      config=Config(max_pool_connections=MAX_POOL_CONNECTIONS))
+# Local inventory cache, enabled with --cache
+inventory_cache = None
+# Session of the target, None for the default session
+session = None
+
+# Replace the module client with one of another profile or region
+def init_clients(target_session):
+    global client, session
+    session = target_session
+    client = session.client('ecr',
+                            config=Config(max_pool_connections=MAX_POOL_CONNECTIONS))
 
 def process_file(file):
     with open(file) as in_file:
@@ -21,65 +52,315 @@ def process_file(file):
             for line in in_file
         )
 
+# Stream images page by page instead of collecting the whole repository
 def get_all_images(ecr_repo_name):
+    if inventory_cache:
+        yield from inventory_cache.get_images(ecr_repo_name)
+        return
     response = client.describe_images(
         repositoryName=f'{ecr_repo_name}',
-        maxResults=1)
-    docker_images = []
-    docker_images += response['imageDetails']
+        maxResults=1000)
+    yield from response['imageDetails']
     next_token = response.get('nextToken', False)
     while next_token:
         response = client.describe_images(
             repositoryName=f'{ecr_repo_name}',
             nextToken=f'{next_token}',
             maxResults=1000)
-        docker_images += response['imageDetails']
+        yield from response['imageDetails']
         next_token = response.get('nextToken', False)
-    return docker_images
 
-# Filter images by pattern and creation time and get list for deletion
-def get_image_list(images, identifier, images_older_than_days,
+def get_all_repos():
+    if inventory_cache:
+        return inventory_cache.get_repositories()
+    response = client.describe_repositories(
+        maxResults=1000)
+    repositories = []
+    repositories += response['repositories']
+    next_token = response.get('nextToken', False)
+    while next_token:
+        response = client.describe_repositories(
+            nextToken=f'{next_token}',
+            maxResults=1000)
+        repositories += response['repositories']
+        next_token = response.get('nextToken', False)
+    return repositories
+
+# Filter repos by name patterns. No patterns means all repos
+def get_repo_names(repositories, repo_pattern):
+    repo_names = []
+    for repository in repositories:
+        if not repo_pattern or any(
+            re.match(pattern, repository['repositoryName'])
+            for pattern in repo_pattern):
+            repo_names.append(repository['repositoryName'])
+    return repo_names
+
+# Identifiers are looked up in a set for exact tags and digests and in a
+# prefix trie for digest prefixes, so matching does not depend on the
+# number of identifiers. Only identifiers starting with the digest
+# algorithm and at least one hex digit are digest prefixes, a tag like
+# "s" matches only that tag.
+# No identifiers means every image matches.
+TRIE_END = ''
+DIGEST_PREFIX = 'sha256:'
+
+def build_matcher(identifier):
+    identifiers = set(filter(None, identifier))
+    trie = {}
+    for item in identifiers:
+        if not item.startswith(DIGEST_PREFIX) or item == DIGEST_PREFIX:
+            continue
+        node = trie
+        for char in item:
+            node = node.setdefault(char, {})
+        node[TRIE_END] = True
+    return {'identifiers': identifiers, 'trie': trie,
+            'match_all': not identifiers}
+
+def match_digest_prefix(trie, digest):
+    node = trie
+    for char in digest:
+        node = node.get(char)
+        if node is None:
+            return False
+        if TRIE_END in node:
+            return True
+    return False
+
+def match_image(matcher, image):
+    if matcher['match_all']:
+        return True
+    identifiers = matcher['identifiers']
+    if image['imageDigest'] in identifiers:
+        return True
+    if not identifiers.isdisjoint(image.get('imageTags', ())):
+        return True
+    return match_digest_prefix(matcher['trie'], image['imageDigest'])
+
+# Filter images by identifiers and creation time and yield images for deletion
+def get_image_list(images, matcher, images_older_than_days,
                     exclude_images):
-    image_list = []
-    image_list_exclude = []
-    compiled_pattern = re.compile('|'.join(identifier))
     now = datetime.date(datetime.now())
     for image in images:
         created_at = datetime.date(image['imagePushedAt'])
         if abs((now - created_at).days) >= images_older_than_days:
-            if re.match(compiled_pattern, image['imageDigest']) or \
-                any(map(lambda v: v in identifier, image['imageTags'])):
-                image_list.append(image)
-            else:
-                image_list_exclude.append(image)
-    if exclude_images:
-        image_list = image_list_exclude
-    return image_list
-
-# Delete all images in deletion list
-def delete_images(image_list, delete_images_arg):
-    if delete_images_arg:
+            if match_image(matcher, image) != exclude_images:
+                yield image
+
+# Count items passing through a stream into stats[key]
+def count_images(images, stats, key):
+    for image in images:
+        stats[key] += 1
+        yield image
+
+def print_images(images):
+    for image in images:
+        pprint(image)
+        yield image
+
+# batch_delete_image accepts up to 100 image IDs per call
+def delete_batch(repo_name, digests):
+    try:
+        response = client.batch_delete_image(
+            repositoryName=f'{repo_name}',
+            imageIds=[{'imageDigest': f'{digest}'} for digest in digests]
+        )
+    except Exception as err:
+        return repo_name, [], [
+            {'imageId': {'imageDigest': digest}, 'failureReason': str(err)}
+            for digest in digests
+        ]
+    return repo_name, response['imageIds'], response['failures']
+
+# Delete all images of the stream. Full batches are submitted while the
+# stream is still being read, so deletion starts with the first page.
+def delete_images(image_list, delete_images_arg, workers=MAX_WORKERS):
+    summary = {'deleted': {}, 'failures': {}}
+    if not delete_images_arg:
+        for _ in image_list:
+            pass
+        return summary
+
+    def collect(future):
+        repo_name, image_ids, failures = future.result()
+        if image_ids:
+            summary['deleted'].setdefault(repo_name, []).extend(image_ids)
+            if inventory_cache:
+                inventory_cache.forget_images(repo_name, set(
+                    image_id['imageDigest'] for image_id in image_ids))
+        if failures:
+            summary['failures'].setdefault(repo_name, []).extend(failures)
+
+    pending = {}
+    futures = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def submit(repo_name, digests):
+            # Keep the number of queued batches bounded
+            if len(futures) >= workers * 2:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    futures.remove(future)
+                    collect(future)
+            futures.add(executor.submit(delete_batch, repo_name, digests))
+
         for image in image_list:
-            response = client.batch_delete_image(
-                repositoryName=f"{image['repositoryName']}",
-                imageIds=[
-                    {
-                        'imageDigest': f"{image['imageDigest']}"
-                    },
-                ]
-            )
-            print("", f"Image {image['imageDigest']} was deleted",
-                    response, "", sep="\n")
+            # dict keeps insertion order and drops duplicate digests
+            digests = pending.setdefault(image['repositoryName'], {})
+            digests[image['imageDigest']] = None
+            if len(digests) == DELETE_BATCH_SIZE:
+                submit(image['repositoryName'], list(digests))
+                del pending[image['repositoryName']]
+        for repo_name, digests in pending.items():
+            submit(repo_name, list(digests))
+        for future in futures:
+            collect(future)
+    print_delete_summary(summary)
+    return summary
+
+def print_delete_summary(summary):
+    print("", "Deleted images:", sep="\n")
+    for repo_name, image_ids in summary['deleted'].items():
+        print(f"{repo_name}: {len(image_ids)}")
+    if summary['failures']:
+        print("", "Failed to delete images:", sep="\n")
+        for repo_name, failures in summary['failures'].items():
+            for failure in failures:
+                print(f"{repo_name} {failure['imageId'].get('imageDigest')}:",
+                        failure.get('failureReason'))
+    print("Total quantity of deleted images:",
+            sum(map(len, summary['deleted'].values())))
+    print("Total quantity of failed deletions:",
+            sum(map(len, summary['failures'].values())))
+
+def process_repo(ecr_repo_name, matcher, images_older_than_days,
+                    exclude_images):
+    stats = {'repositoryName': ecr_repo_name, 'images': 0, 'matched': 0}
+    images = count_images(get_all_images(ecr_repo_name), stats, 'images')
+    image_list = count_images(
+        get_image_list(images, matcher, images_older_than_days,
+                        exclude_images),
+        stats, 'matched')
+    return stats, image_list
+
+# List and filter images of several repos in a bounded thread pool.
+# Workers take repos one at a time and pass matched images through a
+# bounded queue, so a slow consumer (the deleter) holds the scans back and
+# images are yielded while their repos are still being listed.
+def sweep_repos(repo_names, matcher, images_older_than_days,
+                    exclude_images, workers, results):
+    image_queue = queue.Queue(maxsize=SWEEP_QUEUE_SIZE)
+    repos = iter(repo_names)
+    repo_lock = threading.Lock()
+    stop = threading.Event()
+    done = object()
+
+    # Returns False when the consumer has stopped reading
+    def put(item):
+        while not stop.is_set():
+            try:
+                image_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def scan():
+        try:
+            while not stop.is_set():
+                with repo_lock:
+                    repo_name = next(repos, None)
+                if repo_name is None:
+                    return
+                try:
+                    stats, image_list = process_repo(
+                        repo_name, matcher, images_older_than_days,
+                        exclude_images)
+                    for image in image_list:
+                        if not put(image):
+                            return
+                    results.append(stats)
+                except Exception as err:
+                    print(f'Repository scan of {repo_name} failed: {err}')
+        finally:
+            put(done)
+
+    workers = max(1, min(workers, len(repo_names)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in range(workers):
+            executor.submit(scan)
+        try:
+            finished = 0
+            while finished < workers:
+                item = image_queue.get()
+                if item is done:
+                    finished += 1
+                else:
+                    yield item
+        finally:
+            stop.set()
+
+def scan_repo_table(ecr_repo_name, matcher):
+    from ecr_image_table import ImageTable
+    return ImageTable.from_images(
+        ecr_repo_name, get_all_images(ecr_repo_name),
+        lambda image: match_image(matcher, image))
+
+# Load images of several repos into one columnar table
+def build_image_table(repo_names, matcher, workers):
+    from ecr_image_table import ImageTable
+    tables = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(scan_repo_table, repo_name, matcher)
+            for repo_name in repo_names
+        ]
+        for future in as_completed(futures):
+            try:
+                tables.append(future.result())
+            except Exception as err:
+                print(f'Repository scan failed: {err}')
+    return ImageTable.concat(tables)
+
+def get_table_image_mask(table, images_older_than_days, exclude_images,
+                            keep_last):
+    return table.older_than(images_older_than_days) & \
+        (table.matched != exclude_images) & table.not_in_last(keep_last)
+
+def get_table_results(table, mask):
+    images = table.count_per_repo()
+    matched = table.count_per_repo(mask)
+    return [
+        {'repositoryName': repo_name, 'images': images[i],
+            'matched': matched[i]}
+        for i, repo_name in enumerate(table.repo_names)
+    ]
+
+def print_report(results):
+    print("", f"{'Repository':<60} {'Matched':>8} {'Total':>8}", sep="\n")
+    for stats in sorted(results, key=lambda x: x['repositoryName']):
+        if stats['matched']:
+            print(f"{stats['repositoryName']:<60} {stats['matched']:>8} \
+{stats['images']:>8}")
 
 def main():
     parser = argparse.ArgumentParser(
         description='This script prints and deletes images in an ECR repository.')
-    parser.add_argument(
+    repo_group = parser.add_mutually_exclusive_group(required=True)
+    repo_group.add_argument(
         '-n', '--namespace', '--ecr-repository',
         help='ECR project repo name.\
             The name can be the same as a Project name slash Kubernetes namespace.\
-            Example: delivery-eks-qa/delivery-eks-qa-ui',
-        required=True)
+            Example: delivery-eks-qa/delivery-eks-qa-ui')
+    repo_group.add_argument(
+        '--all-repos',
+        help='Process all ECR repositories in the registry.',
+        action="store_true")
+    repo_group.add_argument(
+        '--repo-pattern',
+        help='Process all ECR repositories matching patterns.\
+            Pass multiple patterns with a space. Example: delivery-eks-qa/',
+        nargs='+')
     parser.add_argument(
         '-i', '--identifier',
         help='ECR imageDigest or imageTags. Pass multiple IDs with a space.\
@@ -102,10 +383,41 @@ def main():
         '-d', '--delete',
         help='Delete ECR images.',
         action="store_true")
+    parser.add_argument(
+        '-w', '--workers',
+        help='Number of concurrent workers for scanning repositories\
+            with --all-repos or --repo-pattern and for deleting image batches,\
+            at most 25.',
+        action="store", type=int, default=MAX_WORKERS)
+    parser.add_argument(
+        '-k', '--keep-last',
+        help='Keep indicated quantity of the most recently pushed images\
+            in every repository.',
+        action="store", type=int, default=0)
+    parser.add_argument(
+        '-r', '--report',
+        help='Print reclaimable size per repository instead of the image list.\
+            Nothing is deleted, it cannot be combined with --delete.',
+        action="store_true")
+    add_cache_arguments(parser)
+    add_target_arguments(parser)
     args = parser.parse_args()
+    if not 1 <= args.workers <= MAX_WORKERS_LIMIT:
+        parser.error(f'argument -w/--workers: must be between 1 and {MAX_WORKERS_LIMIT}')
+    if args.report and args.delete:
+        parser.error('argument -r/--report: not allowed with argument -d/--delete')
+
+    targets = get_targets(args)
+    if targets:
+        return exit_status(run_targets(init_clients, run, args, targets))
+    else:
+        run(args)
+
+def run(args):
+    global inventory_cache
+    inventory_cache = get_cache(client, args, session)
 
     ecr_repo_name = args.namespace
-    images = get_all_images(ecr_repo_name)
     image_identifier = args.identifier
     image_list_file = args.file
     images_older_than_days = args.age
@@ -121,15 +433,58 @@ def main():
             one_dimensional_list += item
         identifier += one_dimensional_list
 
-    image_list = get_image_list(images, identifier, images_older_than_days,
-                                exclude_images)
     print("", identifier, sep="\n")
-    pprint(image_list)
-    delete_images(image_list, delete_images_arg)
+    matcher = build_matcher(identifier)
+    if args.report or args.keep_last:
+        # Keep-last-N needs whole repositories, so they are loaded into
+        # a columnar table and filtered there. NumPy is imported only here.
+        from ecr_image_table import print_reclaim_report
+        if ecr_repo_name:
+            repo_names = [ecr_repo_name]
+        else:
+            repo_names = get_repo_names(get_all_repos(), args.repo_pattern)
+        table = build_image_table(repo_names, matcher, args.workers)
+        mask = get_table_image_mask(table, images_older_than_days,
+                                    exclude_images, args.keep_last)
+        results = get_table_results(table, mask)
+        image_list = table.to_images(mask)
+    elif ecr_repo_name:
+        stats, image_list = process_repo(ecr_repo_name, matcher,
+                                        images_older_than_days, exclude_images)
+        results = [stats]
+    else:
+        repo_names = get_repo_names(get_all_repos(), args.repo_pattern)
+        results = []
+        image_list = sweep_repos(repo_names, matcher,
+                                    images_older_than_days, exclude_images,
+                                    args.workers, results)
+    if not args.report:
+        image_list = print_images(image_list)
+    delete_summary = delete_images(image_list, delete_images_arg,
+                                    args.workers)
 
+    if args.report:
+        print_reclaim_report(table, mask)
+    elif not ecr_repo_name:
+        print_report(results)
+    if not ecr_repo_name:
+        print("Total quantity of repositories:", len(results))
     print("", "ECR image identifiers:", identifier, sep="\n")
-    print("Total quantity of matched images:", len(image_list))
-    print("Total quantity of images:", len(images))
+    print("Total quantity of matched images:",
+            sum(stats['matched'] for stats in results))
+    print("Total quantity of images:",
+            sum(stats['images'] for stats in results))
+
+    summary = {
+        'repositories': len(results),
+        'images': int(sum(stats['images'] for stats in results)),
+        'matched': int(sum(stats['matched'] for stats in results)),
+        'deleted': sum(map(len, delete_summary['deleted'].values())),
+        'failed': sum(map(len, delete_summary['failures'].values()))
+    }
+    if args.report:
+        summary['reclaimable'] = int(table.bytes_per_repo(mask).sum())
+    return summary
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -11,8 +11,41 @@ import sys
 from pprint import pprint
 from datetime import datetime
 from os.path import exists
+from botocore.config import Config
+from ecr_inventory_cache import add_cache_arguments, get_cache
+from throttled_executor import ThrottledExecutor, NO_RETRIES
+from fan_out import (add_target_arguments, get_targets, run_targets,
+                     exit_status)
 
-client = boto3.client('ecr')
+MAX_WORKERS = 10
+# DeleteRepository requests per second before throttling backs it off
+DELETE_RATE = 5
+
+# One client is shared by all worker threads, so --workers is limited to
+# the size of its connection pool
+MAX_POOL_CONNECTIONS = 50
+MAX_WORKERS_LIMIT = MAX_POOL_CONNECTIONS
+client = boto3.client('ecr',
+                      config=Config(max_pool_connections=MAX_POOL_CONNECTIONS))
+# Calls run by the ThrottledExecutor use a client without botocore retries,
+# so throttling reaches the executor on the first attempt
+throttled_client = boto3.client(
+    'ecr', config=Config(max_pool_connections=MAX_POOL_CONNECTIONS,
+                         retries=NO_RETRIES))
+# Local inventory cache, enabled with --cache
+inventory_cache = None
+# Session of the target, None for the default session
+session = None
+
+# Replace the module clients with ones of another profile or region
+def init_clients(target_session):
+    global client, throttled_client, session
+    session = target_session
+    client = session.client('ecr',
+                            config=Config(max_pool_connections=MAX_POOL_CONNECTIONS))
+    throttled_client = session.client(
+        'ecr', config=Config(max_pool_connections=MAX_POOL_CONNECTIONS,
+                             retries=NO_RETRIES))
 
 def process_file(file):
     with open(file) as in_file:
@@ -22,6 +55,8 @@ def process_file(file):
         )
 
 def get_all_repos():
+    if inventory_cache:
+        return inventory_cache.get_repositories()
     response = client.describe_repositories(
         maxResults=1)
     repositories = []
@@ -53,17 +88,43 @@ def get_repo_list(repositories, namespace, repos_older_than_days,
         repo_list = repo_list_exclude
     return repo_list
 
-# Delete all repositories in deletion list
-def delete_repos(repo_list, delete_repos_arg):
+def delete_repo(repository):
+    response = throttled_client.delete_repository(
+        registryId=f"{repository['registryId']}",
+        repositoryName=f"{repository['repositoryName']}",
+        force=True
+    )
+    if inventory_cache:
+        inventory_cache.forget_repository(repository['repositoryName'])
+    return response
+
+# Delete all repositories in deletion list concurrently within API limits
+def delete_repos(repo_list, delete_repos_arg, workers=MAX_WORKERS,
+                    rate=DELETE_RATE):
+    summary = {'deleted': [], 'failures': []}
     if delete_repos_arg:
-        for repository in repo_list:
-            response = client.delete_repository(
-                registryId=f"{repository['registryId']}",
-                repositoryName=f"{repository['repositoryName']}",
-                force=True
-            )
-            print("", f"Repository {repository['repositoryName']} was deleted",
-                    response, "", sep="\n")
+        executor = ThrottledExecutor(max_workers=workers, rate=rate)
+        for repository, response, err in executor.map(delete_repo, repo_list):
+            if err:
+                summary['failures'].append(
+                    (repository['repositoryName'], str(err)))
+                print(f"Repository {repository['repositoryName']} \
+was not deleted: {err}")
+            else:
+                summary['deleted'].append(repository['repositoryName'])
+                print(f"Repository {repository['repositoryName']} was deleted")
+        print_delete_summary(summary, executor.throttled)
+    return summary
+
+def print_delete_summary(summary, throttled):
+    print("", f"{'Repository':<60} {'Result':<10}", sep="\n")
+    for repo_name in sorted(summary['deleted']):
+        print(f"{repo_name:<60} {'deleted':<10}")
+    for repo_name, err in sorted(summary['failures']):
+        print(f"{repo_name:<60} {'failed':<10} {err}")
+    print("Total quantity of deleted repositories:", len(summary['deleted']))
+    print("Total quantity of failed deletions:", len(summary['failures']))
+    print("Total quantity of throttled requests:", throttled)
 
 def main():
     parser = argparse.ArgumentParser(
@@ -91,8 +152,29 @@ def main():
         '-d', '--delete',
         help='Delete ECR repos.',
         action="store_true")
+    parser.add_argument(
+        '-w', '--workers',
+        help='Maximum number of repositories deleted concurrently, at most 50.',
+        action="store", type=int, default=MAX_WORKERS)
+    parser.add_argument(
+        '-r', '--rate',
+        help='Initial limit of delete requests per second.',
+        action="store", type=float, default=DELETE_RATE)
+    add_cache_arguments(parser)
+    add_target_arguments(parser)
     args = parser.parse_args()
+    if not 1 <= args.workers <= MAX_WORKERS_LIMIT:
+        parser.error(f'argument -w/--workers: must be between 1 and {MAX_WORKERS_LIMIT}')
 
+    targets = get_targets(args)
+    if targets:
+        return exit_status(run_targets(init_clients, run, args, targets))
+    else:
+        run(args)
+
+def run(args):
+    global inventory_cache
+    inventory_cache = get_cache(client, args, session)
     repositories = get_all_repos()
     repo_list_file = args.file
     repos_older_than_days = args.age
@@ -112,11 +194,19 @@ def main():
                                 exclude_repos)
     print("", namespace, sep="\n")
     pprint(repo_list)
-    delete_repos(repo_list, delete_repos_arg)
+    delete_summary = delete_repos(repo_list, delete_repos_arg, args.workers,
+                                    args.rate)
 
     print("", "ECR search patterns:", namespace, sep="\n")
     print("Total quantity of matched repositories:", len(repo_list))
     print("Total quantity of repositories:", len(repositories))
 
+    return {
+        'repositories': len(repositories),
+        'matched': len(repo_list),
+        'deleted': len(delete_summary['deleted']),
+        'failed': len(delete_summary['failures'])
+    }
+
 if __name__ == '__main__':
     sys.exit(main())
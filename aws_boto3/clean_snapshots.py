@@ -14,11 +14,51 @@ import sys
 import re
 import json
 import argparse
-from datetime import date, datetime
+from datetime import date, datetime, timezone, timedelta
 from os.path import exists
+from botocore.config import Config
+from throttled_executor import (ThrottledExecutor, NO_RETRIES,
+                                get_error_code, is_retryable_error)
+from fan_out import (add_target_arguments, get_targets, run_targets,
+                     exit_status)
 
-ec2 = boto3.resource('ec2')
-client = boto3.client('ec2')
+MAX_WORKERS = 10
+# DeleteSnapshot requests per second before throttling backs it off
+DELETE_RATE = 20
+DESCRIBE_RATE = 10
+DESCRIBE_CHUNK_SIZE = 200
+JOURNAL_FILE = 'clean_snapshots_journal.ndjson'
+# The worker threads share one client, so --workers is limited to the size
+# of its connection pool
+MAX_POOL_CONNECTIONS = 50
+MAX_WORKERS_LIMIT = MAX_POOL_CONNECTIONS
+
+client = boto3.client('ec2',
+                      config=Config(max_pool_connections=MAX_POOL_CONNECTIONS))
+# Calls run by the ThrottledExecutor use a client without botocore retries,
+# so throttling reaches the executor on the first attempt
+throttled_client = boto3.client(
+    'ec2', config=Config(max_pool_connections=MAX_POOL_CONNECTIONS,
+                         retries=NO_RETRIES))
+
+# Replace the module clients with ones of another profile or region
+def init_clients(session):
+    global client, throttled_client
+    client = session.client('ec2',
+                            config=Config(max_pool_connections=MAX_POOL_CONNECTIONS))
+    throttled_client = session.client(
+        'ec2', config=Config(max_pool_connections=MAX_POOL_CONNECTIONS,
+                             retries=NO_RETRIES))
+
+# Only the fields used by the script are kept for every listed snapshot
+class SnapshotRecord:
+    __slots__ = ('id', 'volume_id', 'volume_size', 'start_time')
+
+    def __init__(self, snapshot):
+        self.id = snapshot['SnapshotId']
+        self.volume_id = snapshot.get('VolumeId')
+        self.volume_size = snapshot.get('VolumeSize')
+        self.start_time = snapshot['StartTime']
 
 def json_datetime_serializer(obj):
     if isinstance(obj, (datetime, date)):
@@ -59,56 +99,155 @@ def create_filter_list(snapshot_tags, snapshot_volumes, snap_id):
         filter_list += [['snapshot-id', snap_id]]
     return filter_list
 
-def get_time(snapshot):
+# Snapshots created before the returned date are older than the indicated days
+def get_cutoff(snapshots_older_than_days):
     now = datetime.date(datetime.now())
-    created_at = datetime.date(snapshot.start_time)
-    passed_days = abs((now - created_at).days)
-    return passed_days
+    days = min(snapshots_older_than_days, (now - date.min).days)
+    return now - timedelta(days=days)
 
-def filter_tag(filter_list):
+def get_snap_filters(filter_list):
     keys = ('Name', 'Values')
-    snap_filters = [dict(zip(keys, i)) for i in filter_list]
-    response = ec2.snapshots.filter(Filters=snap_filters)
-    return response
+    return [dict(zip(keys, i)) for i in filter_list]
+
+# List account owned snapshots with the client paginator in pages of 1000
+def scan_snapshots(snap_filters=()):
+    paginator = client.get_paginator('describe_snapshots')
+    for page in paginator.paginate(
+            OwnerIds=['self'], Filters=list(snap_filters),
+            PaginationConfig={'PageSize': 1000}):
+        for snapshot in page['Snapshots']:
+            yield SnapshotRecord(snapshot)
 
+def filter_tag(filter_list):
+    return scan_snapshots(get_snap_filters(filter_list))
+
+# A filter skips IDs deleted since the scan, SnapshotIds would fail the
+# whole chunk with InvalidSnapshot.NotFound
 def describe_snapshot(snapshot_list):
-    response = client.describe_snapshots(SnapshotIds=snapshot_list)
-    return response
-
-def delete_snaps(snapshot_list, delete_snapshots):
-    if delete_snapshots:
-        for snapshot in snapshot_list:
-            try:
-                response = client.delete_snapshot(
-                    SnapshotId=f'{snapshot}',
-                )
-                print(response)
-            except Exception:
-                print(f'Snapshot {snapshot} cannot be removed or does not exist')
-
-def get_filtered_snaps(snapshot_iterator, snapshots_older_than_days):
+    snapshots = []
+    paginator = throttled_client.get_paginator('describe_snapshots')
+    for page in paginator.paginate(
+            OwnerIds=['self'],
+            Filters=[{'Name': 'snapshot-id', 'Values': snapshot_list}]):
+        snapshots += page['Snapshots']
+    return {'Snapshots': snapshots}
+
+# Describe snapshots in chunks concurrently and write every snapshot as one
+# NDJSON line as soon as its chunk arrives
+def show_snapshots(snapshot_list, workers=MAX_WORKERS, out=sys.stdout):
+    chunks = [snapshot_list[i:i + DESCRIBE_CHUNK_SIZE]
+                for i in range(0, len(snapshot_list), DESCRIBE_CHUNK_SIZE)]
+    executor = ThrottledExecutor(max_workers=workers, rate=DESCRIBE_RATE)
+    shown = 0
+    for chunk, response, err in executor.map(describe_snapshot, chunks):
+        if err:
+            print(f'Snapshots {chunk[0]}..{chunk[-1]} cannot be described: \
+{err}', file=sys.stderr)
+            continue
+        for snapshot in response['Snapshots']:
+            out.write(json.dumps(
+                snapshot, default=json_datetime_serializer) + '\n')
+            shown += 1
+        out.flush()
+    return shown
+
+# Map a failed deletion to a journal status
+def classify_error(err):
+    code = get_error_code(err)
+    if code == 'InvalidSnapshot.NotFound':
+        return 'not_found'
+    if code == 'InvalidSnapshot.InUse':
+        return 'in_use'
+    if 'AWS Backup' in str(err):
+        return 'backup_managed'
+    if is_retryable_error(err):
+        return 'retries_exhausted'
+    return 'failed'
+
+# Snapshots deleted or already missing in previous runs
+def read_journal(journal_file):
+    done = set()
+    if journal_file and exists(journal_file):
+        with open(journal_file) as in_file:
+            for line in in_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('status') in ('deleted', 'not_found'):
+                    done.add(record['snapshot_id'])
+    return done
+
+def delete_snapshot(snapshot):
+    return throttled_client.delete_snapshot(SnapshotId=f'{snapshot}')
+
+def delete_snaps(snapshot_list, delete_snapshots, workers=MAX_WORKERS,
+                    journal_file=JOURNAL_FILE, log=sys.stdout):
+    summary = {}
+    if not delete_snapshots:
+        return summary
+    done = read_journal(journal_file)
+    pending = [snapshot for snapshot in snapshot_list if snapshot not in done]
+    if len(pending) < len(snapshot_list):
+        print(f'Skipping {len(snapshot_list) - len(pending)} snapshots \
+deleted in previous runs', file=log)
+
+    journal = open(journal_file, 'a') if journal_file else None
+    executor = ThrottledExecutor(max_workers=workers, rate=DELETE_RATE,
+                                    is_retryable=is_retryable_error)
+    try:
+        for snapshot, _, err in executor.map(delete_snapshot, pending):
+            record = {
+                'snapshot_id': snapshot,
+                'status': 'deleted',
+                'time': datetime.now(timezone.utc).isoformat()
+            }
+            if err:
+                record['status'] = classify_error(err)
+                record['error_code'] = get_error_code(err)
+                record['error'] = str(err)
+                print(f'Snapshot {snapshot} cannot be removed: \
+{record["status"]} {err}', file=log)
+            else:
+                print(f'Snapshot {snapshot} was deleted', file=log)
+            summary[record['status']] = summary.get(record['status'], 0) + 1
+            if journal:
+                journal.write(json.dumps(record) + '\n')
+                journal.flush()
+    finally:
+        if journal:
+            journal.close()
+
+    print("", "Deletion results:", sep="\n", file=log)
+    for status, quantity in sorted(summary.items()):
+        print(f"{status}: {quantity}", file=log)
+    return summary
+
+def get_filtered_snaps(snapshot_iterator, snapshots_older_than_days,
+                        log=sys.stdout):
     snapshot_list = []
+    cutoff = get_cutoff(snapshots_older_than_days)
     for snapshot in snapshot_iterator:
-        passed_days = get_time(snapshot)
-        if passed_days > snapshots_older_than_days:
+        if datetime.date(snapshot.start_time) < cutoff:
             snapshot_list.append(snapshot.id)
             print(f'Snapshot {snapshot.id} for volume {snapshot.volume_id} \
-size {snapshot.volume_size}Gb')
+size {snapshot.volume_size}Gb', file=log)
     return snapshot_list
 
-def get_excluded_snaps(snapshot_iterator, snapshots_older_than_days):
+# Snapshots matched by filters are kept, all other account owned snapshots
+# are listed page by page and checked against a set of kept IDs
+def get_excluded_snaps(snapshot_iterator, snapshots_older_than_days,
+                        log=sys.stdout):
+    excluded_ids = set(snapshot.id for snapshot in snapshot_iterator)
     snapshot_list = []
-    for snapshot in snapshot_iterator:
-        snapshot_list.append(snapshot.id)
-    compiled_pattern = re.compile('|'.join(snapshot_list))
-    get_all_snapshots = ec2.snapshots.all()
-    for snapshot in get_all_snapshots:
-        passed_days = get_time(snapshot)
-        if passed_days > snapshots_older_than_days:
-            if not re.match(compiled_pattern, snapshot.id):
-                snapshot_list.append(snapshot.id)
-                print(f'Snapshot {snapshot.id} for volume {snapshot.volume_id} \
-size {snapshot.volume_size}Gb')
+    cutoff = get_cutoff(snapshots_older_than_days)
+    for snapshot in scan_snapshots():
+        if snapshot.id in excluded_ids:
+            continue
+        if datetime.date(snapshot.start_time) < cutoff:
+            snapshot_list.append(snapshot.id)
+            print(f'Snapshot {snapshot.id} for volume {snapshot.volume_id} \
+size {snapshot.volume_size}Gb', file=log)
     return snapshot_list
 
 def main():
@@ -145,13 +284,47 @@ def main():
     parser_group = parser.add_mutually_exclusive_group()
     parser_group.add_argument(
         '-s', '--show',
-        help='Show JSON description of indicated Snapshots.',
+        help='Show JSON description of indicated Snapshots, one snapshot\
+            per line. Other output goes to stderr.',
         action="store_true")
     parser_group.add_argument(
         '-d', '--delete',
         help='Delete EC2 Snapshots.',
         action="store_true")
+    parser.add_argument(
+        '-w', '--workers',
+        help='Maximum number of snapshots deleted concurrently, at most 50.',
+        action="store", type=int, default=MAX_WORKERS)
+    parser.add_argument(
+        '-j', '--journal',
+        help='NDJSON file with deletion results. Snapshots already deleted\
+            according to the journal are skipped. Pass an empty string\
+            to disable it.',
+        default=JOURNAL_FILE)
+    add_target_arguments(parser)
     args = parser.parse_args()
+    if not 1 <= args.workers <= MAX_WORKERS_LIMIT:
+        parser.error(f'argument -w/--workers: must be between 1 and {MAX_WORKERS_LIMIT}')
+
+    targets = get_targets(args)
+    if targets:
+        # With --show stdout carries only the NDJSON lines of all targets,
+        # they are printed without the target prefix
+        return exit_status(run_targets(
+            init_clients, run, args, targets,
+            log=sys.stderr if args.show else sys.stdout,
+            prefix_stdout=not args.show))
+    else:
+        run(args)
+
+# Keep stdout for NDJSON lines with --show, so it can be piped to jq. The
+# other output is written to log, which is stderr with --show.
+def run(args):
+    out = sys.stdout
+    log = sys.stderr if args.show else sys.stdout
+    return run_snapshots(args, out, log)
+
+def run_snapshots(args, out, log):
 
     snapshot_list_file = args.file
     snapshots_older_than_days = args.age
@@ -174,21 +347,27 @@ def main():
 
     if exclude_snapshots:
         snapshot_list = get_excluded_snaps(
-            snapshot_iterator, snapshots_older_than_days)
+            snapshot_iterator, snapshots_older_than_days, log)
     else:
         snapshot_list = get_filtered_snaps(
-            snapshot_iterator, snapshots_older_than_days)
+            snapshot_iterator, snapshots_older_than_days, log)
 
     if show_snap_details and snapshot_list:
-        snapshot_details = describe_snapshot(snapshot_list)
-        print(json.dumps(
-            snapshot_details,indent=4, default=json_datetime_serializer))
+        show_snapshots(snapshot_list, args.workers, out)
+
+    delete_summary = delete_snaps(snapshot_list, delete_snapshots,
+                                    args.workers, args.journal, log)
 
-    delete_snaps(snapshot_list, delete_snapshots)
+    print("", snapshot_list, sep="\n", file=log)
+    print("", get_snap_filters(filter_list), sep="\n", file=log)
+    print("Total quantity of snapshots: ", len(snapshot_list), file=log)
 
-    print("", snapshot_list, sep="\n")
-    print("", snapshot_iterator._params, sep="\n")
-    print("Total quantity of snapshots: ", len(snapshot_list))
+    return {
+        'snapshots': len(snapshot_list),
+        'deleted': delete_summary.get('deleted', 0),
+        'failed': sum(quantity for status, quantity in delete_summary.items()
+                        if status != 'deleted')
+    }
 
 if __name__ == '__main__':
     sys.exit(main())
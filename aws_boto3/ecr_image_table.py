@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+# Requirements:
+# NUMPY
+
+# Columnar table of ECR images used by clean_ecr_images.py --report and
+# --keep-last. Only the fields the filters need are kept: push time and size
+# as NumPy arrays, digests and tags as interned strings, and the repository
+# as an index into a list of names. Age cutoffs, keep-last-N and size
+# aggregation run as array operations over the whole table.
+
+import sys
+import numpy as np
+from datetime import datetime, timezone
+
+class ImageTable:
+    def __init__(self, repo_names, repo_index, pushed_at, size, digest, tags,
+                    matched):
+        self.repo_names = repo_names
+        self.repo_index = repo_index
+        self.pushed_at = pushed_at
+        self.size = size
+        self.digest = digest
+        self.tags = tags
+        self.matched = matched
+
+    def __len__(self):
+        return len(self.pushed_at)
+
+    # Build the table of one repository from an image stream. matcher is a
+    # function returning True for images matched by identifiers.
+    @classmethod
+    def from_images(cls, repo_name, images, matcher):
+        pushed_at = []
+        size = []
+        digest = []
+        tags = []
+        matched = []
+        for image in images:
+            pushed_at.append(int(image['imagePushedAt'].timestamp()))
+            size.append(image.get('imageSizeInBytes') or 0)
+            digest.append(sys.intern(image['imageDigest']))
+            tags.append(tuple(
+                sys.intern(tag) for tag in image.get('imageTags', ())))
+            matched.append(matcher(image))
+        tag_array = np.empty(len(tags), dtype=object)
+        tag_array[:] = tags
+        return cls(
+            [repo_name],
+            np.zeros(len(pushed_at), dtype=np.int32),
+            np.array(pushed_at, dtype=np.int64).astype('datetime64[s]'),
+            np.array(size, dtype=np.int64),
+            np.array(digest, dtype=object),
+            tag_array,
+            np.array(matched, dtype=bool))
+
+    @classmethod
+    def concat(cls, tables):
+        repo_names = []
+        repo_index = []
+        for table in tables:
+            repo_index.append(table.repo_index + len(repo_names))
+            repo_names += table.repo_names
+        if not tables:
+            return cls([], np.zeros(0, dtype=np.int32),
+                        np.zeros(0, dtype='datetime64[s]'),
+                        np.zeros(0, dtype=np.int64),
+                        np.zeros(0, dtype=object), np.zeros(0, dtype=object),
+                        np.zeros(0, dtype=bool))
+        return cls(
+            repo_names,
+            np.concatenate(repo_index),
+            np.concatenate([table.pushed_at for table in tables]),
+            np.concatenate([table.size for table in tables]),
+            np.concatenate([table.digest for table in tables]),
+            np.concatenate([table.tags for table in tables]),
+            np.concatenate([table.matched for table in tables]))
+
+    # Images pushed at least days ago, compared by calendar date
+    def older_than(self, days, now=None):
+        now = now or datetime.now(timezone.utc)
+        today = np.datetime64(now.date(), 'D')
+        pushed_on = self.pushed_at.astype('datetime64[D]')
+        return np.abs(today - pushed_on).astype(np.int64) >= days
+
+    # Mask of images outside the keep most recently pushed of each repository
+    def not_in_last(self, keep):
+        mask = np.ones(len(self), dtype=bool)
+        if keep <= 0 or not len(self):
+            return mask
+        # Sort by repository, newest first, and rank images inside each group
+        order = np.lexsort((-self.pushed_at.astype(np.int64), self.repo_index))
+        sorted_repos = self.repo_index[order]
+        group_start = np.r_[0, np.flatnonzero(np.diff(sorted_repos)) + 1]
+        group_sizes = np.diff(np.r_[group_start, len(order)])
+        rank = np.arange(len(order)) - np.repeat(group_start, group_sizes)
+        mask[order[rank < keep]] = False
+        return mask
+
+    def count_per_repo(self, mask=None):
+        weights = None if mask is None else mask.astype(np.int64)
+        return np.bincount(self.repo_index, weights=weights,
+                            minlength=len(self.repo_names)).astype(np.int64)
+
+    def bytes_per_repo(self, mask):
+        return np.bincount(self.repo_index, weights=self.size * mask,
+                            minlength=len(self.repo_names)).astype(np.int64)
+
+    # Rows of the mask as image dicts for printing and deletion
+    def to_images(self, mask):
+        for row in np.flatnonzero(mask):
+            image = {
+                'repositoryName': self.repo_names[self.repo_index[row]],
+                'imageDigest': self.digest[row],
+                'imagePushedAt': self.pushed_at[row].astype(datetime).replace(
+                    tzinfo=timezone.utc),
+                'imageSizeInBytes': int(self.size[row])
+            }
+            if self.tags[row]:
+                image['imageTags'] = list(self.tags[row])
+            yield image
+
+def format_size(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(size) < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TiB"
+
+def print_reclaim_report(table, mask):
+    images = table.count_per_repo()
+    selected = table.count_per_repo(mask)
+    reclaimable = table.bytes_per_repo(mask)
+    total = table.bytes_per_repo(np.ones(len(table), dtype=bool))
+    print("", f"{'Repository':<60} {'Images':>8} {'Matched':>8} \
+{'Reclaimable':>12} {'Total':>12}", sep="\n")
+    for i in np.argsort(-reclaimable, kind='stable'):
+        if selected[i]:
+            print(f"{table.repo_names[i]:<60} {images[i]:>8} {selected[i]:>8} \
+{format_size(reclaimable[i]):>12} {format_size(total[i]):>12}")
+    print("Total reclaimable size:", format_size(reclaimable.sum()))
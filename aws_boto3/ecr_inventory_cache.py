@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+# Requirements:
+# AWS CLI
+# BOTO3
+
+# Local SQLite cache of ECR repositories and images shared by
+# clean_ecr_images.py, clean_ecr_repositories.py and
+# set_ecr_repository_policy.py. Entries are keyed by region, registry and
+# repository and are reused while they are younger than the TTL.
+#
+# An expired image entry is refreshed incrementally: list_images returns only
+# digests and tags, so it is compared with the cached digests and
+# describe_images is called only for the new ones. ECR cannot filter
+# describe_images by push time, so the comparison by digest is the cheapest
+# way to fetch only new images. The repository list is small and is always
+# fetched in full.
+
+import os
+import json
+import sqlite3
+import threading
+from time import time
+from datetime import datetime, timezone
+
+import boto3
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'aws-scripts', 'ecr_inventory.sqlite')
+DEFAULT_TTL = 3600
+DESCRIBE_BATCH_SIZE = 100
+# Cached images read per query, get_images doesn't hold the lock between them
+IMAGE_PAGE_SIZE = 1000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS refreshed (
+    registry TEXT NOT NULL,
+    repository TEXT NOT NULL,
+    refreshed_at REAL NOT NULL,
+    PRIMARY KEY (registry, repository)
+);
+CREATE TABLE IF NOT EXISTS repositories (
+    registry TEXT NOT NULL,
+    repository TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    details TEXT NOT NULL,
+    PRIMARY KEY (registry, repository)
+);
+CREATE TABLE IF NOT EXISTS images (
+    registry TEXT NOT NULL,
+    repository TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    pushed_at REAL NOT NULL,
+    tags TEXT NOT NULL,
+    size INTEGER,
+    PRIMARY KEY (registry, repository, digest)
+);
+'''
+
+# The refreshed table keeps the repository list under an empty name
+REPOSITORY_LIST = ''
+
+def to_timestamp(value):
+    return value.timestamp()
+
+def from_timestamp(value):
+    return datetime.fromtimestamp(value, timezone.utc)
+
+def json_datetime_serializer(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError ("Type %s not serializable" % type(obj))
+
+class InventoryCache:
+    def __init__(self, client, sts_client, path=DEFAULT_CACHE_PATH,
+                    ttl=DEFAULT_TTL, refresh=False):
+        self.client = client
+        self.ttl = ttl
+        self.refresh = refresh
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Scripts read the cache from worker threads, the lock serializes
+        # access to the shared connection
+        self.lock = threading.Lock()
+        # Several processes can share the file when targets run in parallel
+        self.connection = sqlite3.connect(path, timeout=60,
+                                            check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        # A registry ID is the account ID of the credentials, the region
+        # makes the key unique. GetCallerIdentity needs no IAM permission.
+        self.registry_id = sts_client.get_caller_identity()['Account']
+        self.registry = f'{client.meta.region_name}:{self.registry_id}'
+        self.refreshed_repos = set()
+
+    def is_fresh(self, repository):
+        if self.refresh and repository not in self.refreshed_repos:
+            return False
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT refreshed_at FROM refreshed '
+                'WHERE registry = ? AND repository = ?',
+                (self.registry, repository)).fetchone()
+        return row is not None and time() - row[0] < self.ttl
+
+    def mark_refreshed(self, repository):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO refreshed VALUES (?, ?, ?)',
+            (self.registry, repository, time()))
+        self.refreshed_repos.add(repository)
+
+    def get_repositories(self):
+        if not self.is_fresh(REPOSITORY_LIST):
+            self.refresh_repositories()
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT details, created_at FROM repositories '
+                'WHERE registry = ? ORDER BY repository',
+                (self.registry,)).fetchall()
+        repositories = []
+        for details, created_at in rows:
+            repository = json.loads(details)
+            repository['createdAt'] = from_timestamp(created_at)
+            repositories.append(repository)
+        return repositories
+
+    def refresh_repositories(self):
+        repositories = []
+        paginator = self.client.get_paginator('describe_repositories')
+        for page in paginator.paginate(PaginationConfig={'PageSize': 1000}):
+            repositories += page['repositories']
+        names = [(repository['repositoryName'],)
+                    for repository in repositories]
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TEMP TABLE IF NOT EXISTS current (repository TEXT)')
+            self.connection.execute('DELETE FROM current')
+            self.connection.executemany(
+                'INSERT INTO current VALUES (?)', names)
+            # Images and timestamps of removed repositories are dropped
+            for table in ('repositories', 'images', 'refreshed'):
+                self.connection.execute(
+                    f'DELETE FROM {table} WHERE registry = ? '
+                    'AND repository != ? '
+                    'AND repository NOT IN (SELECT repository FROM current)',
+                    (self.registry, REPOSITORY_LIST))
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO repositories VALUES (?, ?, ?, ?)',
+                [(self.registry, repository['repositoryName'],
+                    to_timestamp(repository['createdAt']),
+                    json.dumps(repository, default=json_datetime_serializer))
+                    for repository in repositories])
+            self.mark_refreshed(REPOSITORY_LIST)
+
+    # Yields the images page by page. Every page is a new query after the
+    # last digest, so the lock is free while the caller processes a page.
+    def get_images(self, repository):
+        if not self.is_fresh(repository):
+            self.refresh_images(repository)
+        last_digest = ''
+        while True:
+            with self.lock:
+                rows = self.connection.execute(
+                    'SELECT digest, pushed_at, tags, size FROM images '
+                    'WHERE registry = ? AND repository = ? AND digest > ? '
+                    'ORDER BY digest LIMIT ?',
+                    (self.registry, repository, last_digest,
+                        IMAGE_PAGE_SIZE)).fetchall()
+            for digest, pushed_at, tags, size in rows:
+                image = {
+                    'registryId': self.registry_id,
+                    'repositoryName': repository,
+                    'imageDigest': digest,
+                    'imagePushedAt': from_timestamp(pushed_at),
+                    'imageSizeInBytes': size
+                }
+                tags = json.loads(tags)
+                if tags:
+                    image['imageTags'] = tags
+                yield image
+            if len(rows) < IMAGE_PAGE_SIZE:
+                return
+            last_digest = rows[-1][0]
+
+    def refresh_images(self, repository):
+        with self.lock:
+            cached = set(row[0] for row in self.connection.execute(
+                'SELECT digest FROM images '
+                'WHERE registry = ? AND repository = ?',
+                (self.registry, repository)))
+        if self.refresh or not cached:
+            self.reload_images(repository)
+            return
+
+        listed = {}
+        paginator = self.client.get_paginator('list_images')
+        for page in paginator.paginate(
+                repositoryName=repository,
+                PaginationConfig={'PageSize': 1000}):
+            for image_id in page['imageIds']:
+                tags = listed.setdefault(image_id['imageDigest'], [])
+                if 'imageTag' in image_id:
+                    tags.append(image_id['imageTag'])
+
+        new_digests = [digest for digest in listed if digest not in cached]
+        images = []
+        for i in range(0, len(new_digests), DESCRIBE_BATCH_SIZE):
+            response = self.client.describe_images(
+                repositoryName=repository,
+                imageIds=[{'imageDigest': digest}
+                    for digest in new_digests[i:i + DESCRIBE_BATCH_SIZE]])
+            images += response['imageDetails']
+
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'DELETE FROM images '
+                'WHERE registry = ? AND repository = ? AND digest = ?',
+                [(self.registry, repository, digest)
+                    for digest in cached - listed.keys()])
+            # Tags can move between images, so they are updated for all
+            self.connection.executemany(
+                'UPDATE images SET tags = ? '
+                'WHERE registry = ? AND repository = ? AND digest = ?',
+                [(json.dumps(sorted(tags)), self.registry, repository, digest)
+                    for digest, tags in listed.items() if digest in cached])
+            self.insert_images(repository, images)
+            self.mark_refreshed(repository)
+
+    def reload_images(self, repository):
+        images = []
+        paginator = self.client.get_paginator('describe_images')
+        for page in paginator.paginate(
+                repositoryName=repository,
+                PaginationConfig={'PageSize': 1000}):
+            images += page['imageDetails']
+        with self.lock, self.connection:
+            self.connection.execute(
+                'DELETE FROM images WHERE registry = ? AND repository = ?',
+                (self.registry, repository))
+            self.insert_images(repository, images)
+            self.mark_refreshed(repository)
+
+    def insert_images(self, repository, images):
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)',
+            [(self.registry, repository, image['imageDigest'],
+                to_timestamp(image['imagePushedAt']),
+                json.dumps(sorted(image.get('imageTags', []))),
+                image.get('imageSizeInBytes'))
+                for image in images])
+
+    # Keep the cache in line with deletions made by the scripts
+    def forget_images(self, repository, digests):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'DELETE FROM images '
+                'WHERE registry = ? AND repository = ? AND digest = ?',
+                [(self.registry, repository, digest) for digest in digests])
+
+    def forget_repository(self, repository):
+        with self.lock, self.connection:
+            for table in ('repositories', 'images', 'refreshed'):
+                self.connection.execute(
+                    f'DELETE FROM {table} '
+                    'WHERE registry = ? AND repository = ?',
+                    (self.registry, repository))
+
+def add_cache_arguments(parser):
+    parser.add_argument(
+        '--cache',
+        help='Use the local ECR inventory cache.',
+        action="store_true")
+    parser.add_argument(
+        '--cache-ttl',
+        help='Seconds before a cached entry is refreshed.',
+        action="store", type=int, default=DEFAULT_TTL)
+    parser.add_argument(
+        '--cache-path',
+        help='Path to the ECR inventory cache file.',
+        default=DEFAULT_CACHE_PATH)
+    parser.add_argument(
+        '--refresh',
+        help='Reload cached entries from ECR regardless of their age.',
+        action="store_true")
+
+# session is the boto3 session of the client, None for the default one
+def get_cache(client, args, session=None):
+    if not args.cache:
+        return None
+    sts_client = (session or boto3).client(
+        'sts', region_name=client.meta.region_name)
+    return InventoryCache(client, sts_client, path=args.cache_path,
+                            ttl=args.cache_ttl, refresh=args.refresh)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+# Requirements:
+# AWS CLI
+# BOTO3
+
+# Run a cleanup script for several AWS profiles and regions at once. Every
+# target runs in its own process with its own boto3 session and clients.
+# Output of the targets is streamed line by line through a bounded queue
+# and printed with a target prefix as it arrives, so memory does not grow
+# with the output of a target. The summaries of all targets are merged
+# into one table.
+
+import io
+import sys
+import time
+import queue
+import traceback
+import multiprocessing
+from contextlib import redirect_stdout, redirect_stderr
+from concurrent.futures import ProcessPoolExecutor
+
+import boto3
+
+MAX_PROCESSES = 8
+# Output batches in flight, a worker waits while the parent catches up
+OUTPUT_QUEUE_SIZE = 100
+# A batch is sent when it is full, on flush or when it is older than this
+OUTPUT_BATCH_SIZE = 100
+OUTPUT_BATCH_SECONDS = 0.2
+# Queue of output lines of the worker process, set by init_worker
+output_queue = None
+
+def process_file(file):
+    with open(file) as in_file:
+        return tuple(
+            line.strip().split(',') if line.strip() else []
+            for line in in_file
+        )
+
+def add_target_arguments(parser):
+    parser.add_argument(
+        '--regions',
+        help='AWS regions to process. Pass multiple regions with a space.',
+        nargs='+', default=[])
+    parser.add_argument(
+        '--profiles',
+        help='AWS CLI profiles to process. Pass multiple profiles with a space.',
+        nargs='+', default=[])
+    parser.add_argument(
+        '--targets',
+        help='File with profile,region pairs. Pass strings in columns.\
+            Leave the profile empty to use the default credentials.',
+        default='')
+    parser.add_argument(
+        '--processes',
+        help='Number of targets processed concurrently.',
+        action="store", type=int, default=MAX_PROCESSES)
+
+# Every profile is combined with every region. None means the default
+# profile or region of the environment.
+def get_targets(args):
+    targets = []
+    if args.targets:
+        for item in process_file(args.targets):
+            if item:
+                profile = item[0].strip() or None
+                region = item[1].strip() if len(item) > 1 else None
+                targets.append((profile, region or None))
+    if args.regions or args.profiles:
+        for profile in args.profiles or [None]:
+            for region in args.regions or [None]:
+                targets.append((profile, region))
+    return list(dict.fromkeys(targets))
+
+def target_name(target):
+    profile, region = target
+    return f"{profile or 'default'}/{region or 'default'}"
+
+def init_worker(lines):
+    global output_queue
+    output_queue = lines
+
+# Sends the complete lines written to it to the parent process in batches
+class LineWriter(io.TextIOBase):
+    def __init__(self, target, stream):
+        self.target = target
+        self.stream = stream
+        self.partial = ''
+        self.lines = []
+        self.sent_at = time.monotonic()
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        self.lines += lines
+        if len(self.lines) >= OUTPUT_BATCH_SIZE or \
+                time.monotonic() - self.sent_at > OUTPUT_BATCH_SECONDS:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self.lines:
+            output_queue.put((self.target, self.stream, self.lines))
+            self.lines = []
+        self.sent_at = time.monotonic()
+
+    def close_line(self):
+        if self.partial:
+            self.lines.append(self.partial)
+            self.partial = ''
+        self.flush()
+
+# Runs in the worker process: init_clients rebinds the module level clients
+# of the script to a session of the target, run returns a summary dict.
+# A None stream marks the end of the output of the target.
+def run_target(init_clients, run, args, target):
+    profile, region = target
+    out = LineWriter(target, 'stdout')
+    err = LineWriter(target, 'stderr')
+    summary = {}
+    with redirect_stdout(out), redirect_stderr(err):
+        try:
+            session = boto3.Session(profile_name=profile, region_name=region)
+            init_clients(session)
+            summary = run(args)
+        except Exception:
+            traceback.print_exc()
+            summary = {'error': 1}
+    out.close_line()
+    err.close_line()
+    output_queue.put((target, None, None))
+    return target, summary
+
+def print_lines(target, stream, batch, prefix_stdout):
+    prefix = f"[{target_name(target)}] "
+    if stream == 'stdout' and not prefix_stdout:
+        prefix = ''
+    out = sys.stdout if stream == 'stdout' else sys.stderr
+    out.write(''.join(prefix + line + '\n' for line in batch))
+    out.flush()
+
+# Output lines are printed with a [profile/region] prefix. Pass
+# prefix_stdout=False when stdout of the targets carries data, such as
+# NDJSON, its lines are then printed as they are. Banners and the summary
+# table are written to log, pass sys.stderr to keep stdout for the output
+# of the targets only.
+def run_targets(init_clients, run, args, targets, log=sys.stdout,
+                    prefix_stdout=True):
+    processes = max(1, min(args.processes, len(targets)))
+    lines = multiprocessing.Queue(OUTPUT_QUEUE_SIZE)
+    with ProcessPoolExecutor(max_workers=processes, initializer=init_worker,
+                                initargs=(lines,)) as executor:
+        futures = {
+            executor.submit(run_target, init_clients, run, args, target): target
+            for target in targets
+        }
+        finished = set()
+        while len(finished) < len(targets):
+            try:
+                target, stream, batch = lines.get(timeout=1)
+            except queue.Empty:
+                # A worker that died sends no end marker
+                finished.update(futures[future] for future in futures
+                                if future.done() and future.exception())
+                continue
+            if stream is None:
+                finished.add(target)
+                print(f"===== {target_name(target)} done =====",
+                        file=log, flush=True)
+                continue
+            print_lines(target, stream, batch, prefix_stdout)
+        sys.stdout.flush()
+        summaries = []
+        for future, target in futures.items():
+            if future.exception():
+                print(f"===== {target_name(target)} failed: \
+{future.exception()} =====", file=log)
+                summaries.append((target, {'error': 1}))
+            else:
+                summaries.append(future.result())
+    print_summary_table(summaries, log)
+    return summaries
+
+# Exit status of a fan-out run, 1 when any target failed
+def exit_status(summaries):
+    return 1 if any(summary.get('error') for _, summary in summaries) else 0
+
+def print_summary_table(summaries, log=sys.stdout):
+    columns = []
+    for _, summary in summaries:
+        for key in summary:
+            if key not in columns:
+                columns.append(key)
+    totals = dict.fromkeys(columns, 0)
+    print("", f"{'Target':<40}" + "".join(
+        f" {column:>12}" for column in columns), sep="\n", file=log)
+    for target, summary in sorted(summaries, key=lambda x: target_name(x[0])):
+        print(f"{target_name(target):<40}" + "".join(
+            f" {summary.get(column, 0):>12}" for column in columns), file=log)
+        for column in columns:
+            totals[column] += summary.get(column, 0)
+    print(f"{'Total':<40}" + "".join(
+        f" {totals[column]:>12}" for column in columns), file=log)
@@ -9,10 +9,30 @@ import re
 import argparse
 import sys
 import json
+import hashlib
 from pprint import pprint
 from os.path import exists
+from botocore.config import Config
+from ecr_inventory_cache import add_cache_arguments, get_cache
+from throttled_executor import ThrottledExecutor, NO_RETRIES, get_error_code
 
-client = boto3.client('ecr')
+MAX_WORKERS = 10
+# ECR policy requests per second before throttling backs it off
+POLICY_RATE = 10
+
+# One client is shared by all worker threads, so --workers is limited to
+# the size of its connection pool
+MAX_POOL_CONNECTIONS = 50
+MAX_WORKERS_LIMIT = MAX_POOL_CONNECTIONS
+client = boto3.client('ecr',
+                      config=Config(max_pool_connections=MAX_POOL_CONNECTIONS))
+# Calls run by the ThrottledExecutor use a client without botocore retries,
+# so throttling reaches the executor on the first attempt
+throttled_client = boto3.client(
+    'ecr', config=Config(max_pool_connections=MAX_POOL_CONNECTIONS,
+                         retries=NO_RETRIES))
+# Local inventory cache, enabled with --cache
+inventory_cache = None
 
 def process_file(file):
     with open(file) as in_file:
@@ -32,6 +52,8 @@ def json_format(response):
     return json_dump
 
 def get_all_repos():
+    if inventory_cache:
+        return inventory_cache.get_repositories()
     response = client.describe_repositories(
         maxResults=1)
     repositories = []
@@ -80,6 +102,79 @@ def set_policy(repo_list, policy_string):
         print("", f"Policy for {repository['repositoryName']} was set to:",
             json_response, "", sep="\n")
 
+# Policies are compared by a hash of their JSON with sorted keys and
+# without whitespace, so formatting differences are ignored
+def policy_hash(policy_string):
+    canonical = json.dumps(json.loads(policy_string), sort_keys=True,
+                            separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+# Match repos against all patterns in a single pass
+def get_matching_repos(repositories, namespace):
+    repo_list = []
+    for repository in repositories:
+        if any(re.match(pattern, repository['repositoryName'])
+                for pattern in namespace):
+            repo_list.append(repository)
+    return repo_list
+
+def fetch_policy_hash(repository):
+    try:
+        response = throttled_client.get_repository_policy(
+            registryId=f"{repository['registryId']}",
+            repositoryName=f"{repository['repositoryName']}"
+        )
+    except Exception as err:
+        if get_error_code(err) == 'RepositoryPolicyNotFoundException':
+            return None
+        raise
+    return policy_hash(response['policyText'])
+
+def put_policy(item):
+    repository, policy_string = item
+    return throttled_client.set_repository_policy(
+        registryId=f"{repository['registryId']}",
+        repositoryName=f"{repository['repositoryName']}",
+        policyText=f"{policy_string}",
+        force=True
+    )
+
+# Fetch current policies concurrently and write only the differing ones
+def sync_policy(repo_list, policy_string, workers=MAX_WORKERS,
+                rate=POLICY_RATE):
+    wanted_hash = policy_hash(policy_string)
+    summary = {'compliant': [], 'updated': [], 'failures': []}
+
+    outdated = []
+    executor = ThrottledExecutor(max_workers=workers, rate=rate)
+    for repository, current_hash, err in executor.map(
+            fetch_policy_hash, repo_list):
+        if err:
+            summary['failures'].append((repository['repositoryName'], str(err)))
+        elif current_hash == wanted_hash:
+            summary['compliant'].append(repository['repositoryName'])
+        else:
+            outdated.append(repository)
+
+    executor = ThrottledExecutor(max_workers=workers, rate=rate)
+    for (repository, _), _, err in executor.map(
+            put_policy, [(repository, policy_string)
+                            for repository in outdated]):
+        if err:
+            summary['failures'].append((repository['repositoryName'], str(err)))
+        else:
+            summary['updated'].append(repository['repositoryName'])
+            print(f"Policy for {repository['repositoryName']} was updated")
+
+    for repo_name, err in sorted(summary['failures']):
+        print(f"Policy for {repo_name} was not synced: {err}")
+    print()
+    print("Total quantity of compliant repositories:",
+            len(summary['compliant']))
+    print("Total quantity of updated repositories:", len(summary['updated']))
+    print("Total quantity of failed repositories:", len(summary['failures']))
+    return summary
+
 def delete_policy(repo_list, delete):
     if delete:
         for repository in repo_list:
@@ -122,8 +217,22 @@ def main():
         '-d', '--delete',
         help='Delete ECR repo policy.',
         action="store_true")
+    parser.add_argument(
+        '--sync',
+        help='Set the --policy only for repos whose current policy differs.',
+        action="store_true")
+    parser.add_argument(
+        '-w', '--workers',
+        help='Maximum number of concurrent policy requests with --sync,\
+            at most 50.',
+        action="store", type=int, default=MAX_WORKERS)
+    add_cache_arguments(parser)
     args = parser.parse_args()
+    if not 1 <= args.workers <= MAX_WORKERS_LIMIT:
+        parser.error(f'argument -w/--workers: must be between 1 and {MAX_WORKERS_LIMIT}')
 
+    global inventory_cache
+    inventory_cache = get_cache(client, args)
     repositories = get_all_repos()
 
     namespace = []
@@ -135,18 +244,27 @@ def main():
             one_dimensional_list += item
         namespace += one_dimensional_list
 
-    full_repo_list = []
-    for pattern in (namespace):
-        repo_list = get_repo_list(repositories, pattern)
-        if not args.show:
-            print("", pattern, sep="\n")
-            pprint(repo_list)
-        full_repo_list += repo_list
-        get_policy(repo_list, show=args.show)
-        if exists(args.policy):
-            policy_string = process_policy(args.policy)
-            set_policy(repo_list, policy_string)
-        delete_policy(repo_list, delete=args.delete)
+    policy_string = ''
+    if exists(args.policy):
+        policy_string = process_policy(args.policy)
+
+    if args.sync:
+        if not policy_string:
+            parser.error('--sync requires an existing --policy file')
+        full_repo_list = get_matching_repos(repositories, namespace)
+        sync_policy(full_repo_list, policy_string, args.workers)
+    else:
+        full_repo_list = []
+        for pattern in (namespace):
+            repo_list = get_repo_list(repositories, pattern)
+            if not args.show:
+                print("", pattern, sep="\n")
+                pprint(repo_list)
+            full_repo_list += repo_list
+            get_policy(repo_list, show=args.show)
+            if policy_string:
+                set_policy(repo_list, policy_string)
+            delete_policy(repo_list, delete=args.delete)
 
     print("", "ECR search patterns:", namespace, sep="\n")
     print("Total quantity of found repositories:",
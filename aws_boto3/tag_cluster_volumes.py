@@ -4,44 +4,60 @@
 # AWS CLI
 # BOTO3
 
+import os
+import sys
 import boto3
 
+# The rule engine and the bulk tagging are shared with the Lambdas, see
+# aws_lambdas/volume_tag_rules.py
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, 'aws_lambdas'))
+from volume_tag_rules import VolumeTagRules, apply_plan
+
 AWS_REGION = "eu-central-1"
-ec2 = boto3.resource('ec2', region_name=AWS_REGION)
+ec2 = boto3.client('ec2', region_name=AWS_REGION)
+
+# One tag_value rule: volumes owned by the cluster get user:tag of the event
+def get_cluster_rules(cluster, user_tag):
+    return VolumeTagRules([{
+        'match': 'tag_value',
+        'key': f"kubernetes.io/cluster/{cluster}",
+        'value': 'owned',
+        'tag': user_tag
+    }])
 
 def getVolumesList(ec2, cluster):
-    volume_id_list = []
-    custom_filter = [
-        {
-            'Name': f"tag:kubernetes.io/cluster/{cluster}",
-            'Values': ['owned',]
-        }]
-
-    for volume in ec2.volumes.filter(Filters=custom_filter):
-        tagExist = False
-        for tag in volume.tags:
-            if tag['Key'] == 'user:tag':
-                tagExist = True
-        if not tagExist:
-           volume_id_list.append(volume.id)
-           print("Volume " + str(volume.id) + " doesn't have user:tag")
-        else:
-           print("Volume " + str(volume.id) + " has already been tagged by user:tag")
-    return volume_id_list
-
-def tag_volume(ec2, volume_id_list, user_tag):
-    for volume_id in volume_id_list:
-        volume = ec2.Volume(id=volume_id)
-        volume.create_tags(Tags=[{'Key': 'user:tag', 'Value': user_tag }])
-        print("Volume " + str(volume_id) + " was tagged by user:tag " + user_tag)
+    volume_list = []
+    paginator = ec2.get_paginator('describe_volumes')
+    for page in paginator.paginate(
+            Filters=[{
+                'Name': f"tag:kubernetes.io/cluster/{cluster}",
+                'Values': ['owned',]
+            }],
+            PaginationConfig={'PageSize': 500}):
+        volume_list += page['Volumes']
+    return volume_list
+
+def tag_volume(ec2, tag_plan):
+    tagged, failed = apply_plan(ec2, tag_plan)
+    for volume_id, key, value in tagged:
+        print("Volume " + str(volume_id) + " was tagged by " + key + " " + value)
+    for volume_id, key, value, err in failed:
+        print("Volume " + str(volume_id) + " was not tagged by " + key + " "
+              + value + ": " + err)
+    return failed
 
 def lambda_handler(event, context):
     user_tag = event["user_tag"]
     cluster = event["cluster"]
     print("User:tag is " + user_tag)
     print("Cluster is " + cluster)
-    volume_id_list = getVolumesList(ec2, cluster)
-    tag_volume(ec2, volume_id_list, user_tag)
+    rules = get_cluster_rules(cluster, user_tag)
+    volume_list = getVolumesList(ec2, cluster)
+    tag_plan = rules.plan(volume_list)
+    planned = sum(len(volume_ids) for volume_ids in tag_plan.values())
+    print(str(len(volume_list) - planned) + " volumes have already been tagged by user:tag")
+    tag_volume(ec2, tag_plan)
 
 # # use it for local development
 # if __name__ == '__main__':
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+# Requirements:
+# BOTO3
+
+# Concurrent runner for AWS API calls that would hit API throttling when
+# simply parallelized. Calls pass a token bucket rate limiter and an adaptive
+# concurrency limit. Throttling errors (or any errors accepted by the
+# is_retryable function) halve the rate and the concurrency and the call is
+# retried with exponential backoff. Calls slower than the target
+# latency lower the concurrency, fast calls raise it back step by step.
+#
+# botocore retries throttled calls on its own before the error reaches the
+# executor, which hides throttling from the rate limiter and adds the
+# retries to the measured latency. Clients used for the calls run by the
+# executor are created with NO_RETRIES, and the executor retries the
+# throttling, server and connection errors botocore would have retried.
+
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.exceptions import (ClientError, ConnectionError,
+                                    ConnectionClosedError, ReadTimeoutError)
+
+THROTTLING_ERROR_CODES = (
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'SlowDown',
+)
+# Server side errors worth another attempt besides throttling
+TRANSIENT_ERROR_CODES = (
+    'InternalError',
+    'InternalFailure',
+    'ServiceUnavailable',
+    'Unavailable',
+    'RequestTimeout',
+    'RequestTimeoutException',
+)
+# botocore client config: one attempt, the executor does the retries
+NO_RETRIES = {'total_max_attempts': 1}
+
+def get_error_code(err):
+    if isinstance(err, ClientError):
+        return err.response.get('Error', {}).get('Code', '')
+    return ''
+
+def is_throttling_error(err):
+    return get_error_code(err) in THROTTLING_ERROR_CODES
+
+def is_retryable_error(err):
+    return is_throttling_error(err) or \
+        get_error_code(err) in TRANSIENT_ERROR_CODES or \
+        isinstance(err, (ConnectionError, ConnectionClosedError,
+                            ReadTimeoutError))
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None, min_rate=0.5):
+        self.rate = float(rate)
+        self.max_rate = float(rate)
+        self.min_rate = min(min_rate, self.rate)
+        self.capacity = capacity or max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                            self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def slow_down(self):
+        with self.lock:
+            self.refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def speed_up(self):
+        with self.lock:
+            self.refill()
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+class AdaptiveConcurrency:
+    def __init__(self, max_limit, target_latency):
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.target_latency = target_latency
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+
+    def release(self, latency=None):
+        with self.condition:
+            self.active -= 1
+            if latency is not None:
+                if latency > self.target_latency:
+                    self.limit = max(1, self.limit * 0.75)
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def decrease(self):
+        with self.condition:
+            self.limit = max(1, self.limit / 2)
+
+class ThrottledExecutor:
+    def __init__(self, max_workers=10, rate=5, target_latency=2.0,
+                    max_retries=8, base_delay=0.5, max_delay=30,
+                    is_retryable=is_retryable_error):
+        self.max_workers = max_workers
+        self.is_retryable = is_retryable
+        self.bucket = TokenBucket(rate)
+        self.concurrency = AdaptiveConcurrency(max_workers, target_latency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def backoff(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        time.sleep(random.uniform(0, delay))
+
+    # Returns (item, result, error) where error is None on success
+    def call(self, function, item):
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            self.concurrency.acquire()
+            start = time.monotonic()
+            try:
+                result = function(item)
+            except Exception as err:
+                self.concurrency.release()
+                if self.is_retryable(err) and attempt < self.max_retries:
+                    with self.lock:
+                        self.throttled += 1
+                    self.bucket.slow_down()
+                    self.concurrency.decrease()
+                    self.backoff(attempt)
+                    continue
+                return item, None, err
+            self.concurrency.release(time.monotonic() - start)
+            self.bucket.speed_up()
+            return item, result, None
+
+    # Run function for every item, results are yielded in completion order
+    def map(self, function, items):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.call, function, item)
+                        for item in items]
+            for future in as_completed(futures):
+                yield future.result()
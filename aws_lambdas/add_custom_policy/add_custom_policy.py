@@ -12,9 +12,17 @@ else:
                         level=logging.INFO,
                         datefmt='%Y-%m-%d %H:%M:%S')
 
-client = boto3.client('ecr')
+# This Lambda is packaged on its own, so it keeps a local lazy client
+# instead of aws_clients.py: the client is created on first use
+client = None
 region = 'eu-central-1'
 
+def get_client():
+    global client
+    if client is None:
+        client = boto3.client('ecr')
+    return client
+
 def json_format(response):
     json_dict = json.loads(response['policyText'])
     json_dump = json.dumps(json_dict, indent=4)
@@ -26,7 +34,7 @@ def process_policy(policy):
         return contents
 
 def set_policy(event, policy_string, registry_id):
-    response = client.set_repository_policy(
+    response = get_client().set_repository_policy(
         registryId=f"{registry_id}",
         repositoryName=f"{event}",
         policyText=f"{policy_string}",
@@ -0,0 +1,50 @@
+import threading
+
+import boto3
+
+# Lazy, memoized boto3 clients and resources shared by the Lambda handlers.
+# Nothing is created at import time: a client is created on its first use
+# and reused by later calls and by warm invocations. Loading the service
+# model is the most expensive part of a cold start, so a handler only pays
+# for the services the invocation actually uses.
+#
+# The default boto3 session is not thread safe, creation is serialized by a
+# lock. The created clients are thread safe and can be shared by threads.
+
+lock = threading.Lock()
+session = None
+clients = {}
+
+
+def get_session():
+    global session
+    if session is None:
+        session = boto3.session.Session()
+    return session
+
+
+def get_client(service, region_name=None, config=None):
+    key = ('client', service, region_name, config)
+    if key not in clients:
+        with lock:
+            if key not in clients:
+                clients[key] = get_session().client(service, region_name=region_name, config=config)
+    return clients[key]
+
+
+# Resources load a larger model than clients, prefer get_client
+def get_resource(service, region_name=None, config=None):
+    key = ('resource', service, region_name, config)
+    if key not in clients:
+        with lock:
+            if key not in clients:
+                clients[key] = get_session().resource(service, region_name=region_name, config=config)
+    return clients[key]
+
+
+# Drops the cached session and clients, e.g. after the credentials changed
+def reset():
+    global session
+    with lock:
+        clients.clear()
+        session = None
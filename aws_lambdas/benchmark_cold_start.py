@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+# Cold start benchmark of the Lambda handlers in this directory. Every
+# handler is measured in a fresh Python process, as a cold Lambda container:
+#   import  -- import of the handler module (boto3 included)
+#   init    -- creation of boto3 sessions, clients and resources
+#   invoke  -- the first invocation without the init time
+#   warm    -- a second invocation in the same process
+# AWS calls are answered by a stub with empty canned responses, no AWS calls
+# are made. Compare the table before and after a change to the handlers.
+
+# Requirements:
+# BOTO3
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import statistics
+import subprocess
+import importlib.util
+from contextlib import redirect_stdout, redirect_stderr
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# name: (file, handler, event)
+HANDLERS = {
+    'tag_all_volumes': ('tag_all_volumes.py', 'lambda_handler', {}),
+    'tag_cluster_volumes': ('tag_cluster_volumes.py', 'lambda_handler',
+                            {'user_tag': 'benchmark', 'cluster': 'benchmark'}),
+    'shared-tag-volume': ('shared-tag-volume.py', 'lambdaHandler', {}),
+    'shared-tag-volume-event': ('shared-tag-volume.py', 'volumeEventHandler',
+                                'shared-tag-volume-events/create_volume.json'),
+    'instance_scheduler': ('instance_scheduler.py', 'main',
+                           {'action': 'start', 'instance_parameter': 'benchmark'}),
+    'instance_scheduler-schedule': ('instance_scheduler.py', 'main', {'action': 'schedule'}),
+    'cloudguru-stop-ec2': ('cloudguru-stop-ec2.py', 'lambda_handler', {'dry_run': True}),
+}
+
+def stub_response(operation_name, api_params):
+    if operation_name == 'DescribeRegions':
+        return {'Regions': [{'RegionName': 'eu-central-1'}, {'RegionName': 'us-east-1'}]}
+    if operation_name == 'GetParameters':
+        return {'Parameters': [{'Name': name, 'Value': 'i-0123456789abcdef0'}
+                               for name in api_params['Names']],
+                'InvalidParameters': []}
+    responses = {
+        'DescribeVolumes': {'Volumes': []},
+        'DescribeInstances': {'Reservations': []},
+        'LookupEvents': {'Events': []},
+        'GetParametersByPath': {'Parameters': []},
+    }
+    return responses.get(operation_name, {})
+
+class Context:
+    aws_request_id = 'benchmark'
+    invoked_function_arn = 'arn:aws:lambda:eu-central-1:123456789012:function:benchmark'
+
+    def get_remaining_time_in_millis(self):
+        return 300000
+
+# Runs in the child process, prints the timings as JSON
+def measure(name):
+    file, handler, event = HANDLERS[name]
+    if isinstance(event, str):
+        with open(os.path.join(HERE, event)) as f:
+            event = json.load(f)
+    sys.path.insert(0, HERE)
+    logging.disable(logging.CRITICAL)
+    output = open(os.devnull, 'w')
+
+    start = time.perf_counter()
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), os.path.join(HERE, file))
+    module = importlib.util.module_from_spec(spec)
+    with redirect_stdout(output), redirect_stderr(output):
+        spec.loader.exec_module(module)
+    import_time = time.perf_counter() - start
+
+    # the stub is installed after the import, so it isn't part of it
+    import boto3
+    import botocore.client
+    botocore.client.BaseClient._make_api_call = \
+        lambda client, operation_name, api_params: stub_response(operation_name, api_params)
+    init_time = [0.0]
+    for method in ('client', 'resource'):
+        create = getattr(boto3.session.Session, method)
+        def timed(self, *args, create=create, **kwargs):
+            start = time.perf_counter()
+            try:
+                return create(self, *args, **kwargs)
+            finally:
+                init_time[0] += time.perf_counter() - start
+        setattr(boto3.session.Session, method, timed)
+
+    timings = {'import': import_time}
+    for run in ('invoke', 'warm'):
+        init_time[0] = 0.0
+        start = time.perf_counter()
+        with redirect_stdout(output), redirect_stderr(output):
+            getattr(module, handler)(event, Context())
+        timings[run] = time.perf_counter() - start - init_time[0]
+        if run == 'invoke':
+            timings['init'] = init_time[0]
+    print(json.dumps(timings))
+
+def run_child(name, workdir):
+    env = dict(os.environ,
+               AWS_ACCESS_KEY_ID='benchmark', AWS_SECRET_ACCESS_KEY='benchmark',
+               AWS_DEFAULT_REGION='eu-central-1', AWS_REGION='eu-central-1',
+               AWS_CONFIG_FILE=os.devnull, AWS_SHARED_CREDENTIALS_FILE=os.devnull,
+               CURSOR_FILE=os.path.join(workdir, 'cursor.json'),
+               LEASE_FILE=os.path.join(workdir, 'leases.sqlite'))
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', name],
+        env=env, cwd=workdir, capture_output=True, text=True)
+    if result.returncode:
+        raise RuntimeError(f'{name} failed:\n{result.stderr}')
+    return json.loads(result.stdout.splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='This script measures cold starts of the Lambda handlers.')
+    parser.add_argument(
+        '-n', '--runs',
+        help='Cold starts per handler, the median is printed.',
+        action="store", type=int, default=5)
+    parser.add_argument(
+        '-H', '--handlers',
+        help='Handlers to measure. Pass multiple handlers with a space.',
+        nargs='+', choices=sorted(HANDLERS), default=list(HANDLERS))
+    parser.add_argument(
+        '--json',
+        help='Print the medians as JSON.',
+        action="store_true")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return measure(args.child)
+
+    columns = ('import', 'init', 'invoke', 'warm')
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in args.handlers:
+            runs = [run_child(name, workdir) for _ in range(args.runs)]
+            results[name] = {column: statistics.median(run[column] for run in runs)
+                             for column in columns}
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+        return
+    print(f"{'Handler':<30}" + "".join(f" {column + ' ms':>10}" for column in columns))
+    for name, timings in results.items():
+        print(f"{name:<30}" + "".join(f" {timings[column] * 1000:>10.1f}" for column in columns))
+
+if __name__ == '__main__':
+    sys.exit(main())
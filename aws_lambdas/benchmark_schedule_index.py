@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+# Simulation of the tag driven schedule of instance_scheduler.py on a fake
+# clock. Every tick runs the real handler against a stubbed EC2 fleet, then
+# the fleet is checked against the schedules computed independently:
+#   - an instance with a transition since the previous tick is in the
+#     state of its last transition
+#   - any other instance keeps its state, so a transition is never replayed
+# Between ticks some instances are started or stopped by hand, ticks run
+# late and the index is dropped as on a cold start. The last tick time is
+# kept in a temporary SCHEDULE_STATE_FILE, no AWS calls are made.
+
+# Requirements:
+# BOTO3
+
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SCHEDULES = [
+    '08:00-18:00 mon-fri',
+    '08:30-17:30 mon-fri Europe/Kyiv',
+    '22:00-06:00',
+    'start=0 9 * * *; stop=0 21 * * *; tz=America/New_York',
+    'start=*/30 * * * *; stop=15,45 * * * *',
+    'stop=0 20 * * *',
+    'not a schedule',
+]
+# target state of an action and the states the action changes
+TARGETS = {'start': ('running', ('stopped', 'stopping')), 'stop': ('stopped', ('pending', 'running'))}
+
+
+class Fleet:
+    def __init__(self, count, rng):
+        self.state = {}
+        self.tags = {}
+        for n in range(count):
+            instance_id = f'i-{n:017x}'
+            self.state[instance_id] = rng.choice(['running', 'stopped'])
+            self.tags[instance_id] = rng.choice(SCHEDULES)
+        self.calls = {}
+
+    def respond(self, operation_name, api_params):
+        self.calls[operation_name] = self.calls.get(operation_name, 0) + 1
+        if operation_name == 'DescribeInstances':
+            ids = list(self.state)
+            start = int(api_params.get('NextToken') or 0)
+            size = api_params.get('MaxResults') or 1000
+            page = {'Reservations': [{'Instances': [
+                {'InstanceId': instance_id, 'State': {'Name': self.state[instance_id]},
+                 'Tags': [{'Key': 'Schedule', 'Value': self.tags[instance_id]}]}
+                for instance_id in ids[start:start + size]]}]}
+            if start + size < len(ids):
+                page['NextToken'] = str(start + size)
+            return page
+        if operation_name in ('StartInstances', 'StopInstances'):
+            target = 'running' if operation_name == 'StartInstances' else 'stopped'
+            for instance_id in api_params['InstanceIds']:
+                self.state[instance_id] = target
+            return {}
+        raise AssertionError('Unexpected call ' + operation_name)
+
+
+# {tag value: last action} of the transitions in (after, until]
+def due_actions(schedules, after, until):
+    actions = {}
+    for text, schedule in schedules.items():
+        when = after
+        while schedule:
+            transition = schedule.next_transition(when)
+            if not transition or transition[0] > until:
+                break
+            when, actions[text] = transition
+    return actions
+
+
+def simulate(args, workdir):
+    os.environ.update(
+        AWS_ACCESS_KEY_ID='benchmark', AWS_SECRET_ACCESS_KEY='benchmark',
+        AWS_DEFAULT_REGION='eu-central-1', AWS_CONFIG_FILE=os.devnull,
+        AWS_SHARED_CREDENTIALS_FILE=os.devnull,
+        SCHEDULE_STATE_FILE=os.path.join(workdir, 'last_tick'))
+    os.environ.pop('SCHEDULE_STATE_PARAMETER', None)
+    sys.path.insert(0, HERE)
+    logging.disable(logging.CRITICAL)
+    import botocore.client
+    import instance_scheduler
+    from instance_schedule import Schedule, ScheduleIndex
+
+    rng = random.Random(args.seed)
+    fleet = Fleet(args.instances, rng)
+    botocore.client.BaseClient._make_api_call = \
+        lambda client, operation_name, api_params: fleet.respond(operation_name, api_params)
+    schedules = {}
+    for text in SCHEDULES:
+        try:
+            schedules[text] = Schedule.parse(text)
+        except (ValueError, KeyError, IndexError):
+            schedules[text] = None
+
+    now = datetime(2026, 10, 12, tzinfo=timezone.utc)
+    end = now + timedelta(days=args.days)
+    interval = timedelta(minutes=args.interval)
+    previous = None
+    stats = {'ticks': 0, 'cold': 0, 'late': 0, 'changed': 0, 'errors': 0}
+    tick_time = 0.0
+    while now < end:
+        # manual changes between ticks
+        for instance_id in rng.sample(list(fleet.state), min(args.manual, len(fleet.state))):
+            fleet.state[instance_id] = rng.choice(['running', 'stopped'])
+        if rng.random() < args.cold_start:
+            instance_scheduler.schedule_index = ScheduleIndex()
+            stats['cold'] += 1
+        before = dict(fleet.state)
+
+        instance_scheduler.clock = lambda: now
+        start = time.perf_counter()
+        result = instance_scheduler.main({'action': 'schedule'}, None)
+        tick_time += time.perf_counter() - start
+        stats['ticks'] += 1
+        stats['changed'] += len(result['started']) + len(result['stopped'])
+
+        # the first tick takes only the transitions after it
+        actions = due_actions(schedules, previous, now) if previous else {}
+        for instance_id, state in fleet.state.items():
+            action = actions.get(fleet.tags[instance_id])
+            expected = before[instance_id]
+            if action and before[instance_id] in TARGETS[action][1]:
+                expected = TARGETS[action][0]
+            if state != expected:
+                stats['errors'] += 1
+                if stats['errors'] <= 10:
+                    print(f'{now:%a %Y-%m-%d %H:%M} {instance_id} {fleet.tags[instance_id]!r}: '
+                          f'{before[instance_id]} -> {state}, expected {expected}')
+        previous = now
+        late = rng.random() < args.late
+        stats['late'] += late
+        now += interval * (rng.randint(2, 6) if late else 1)
+    return stats, tick_time, fleet.calls
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='This script simulates the instance schedule on a fake clock.')
+    parser.add_argument(
+        '-i', '--instances',
+        help='Number of scheduled instances.',
+        action="store", type=int, default=5000)
+    parser.add_argument(
+        '-d', '--days',
+        help='Simulated days.',
+        action="store", type=float, default=3)
+    parser.add_argument(
+        '--interval',
+        help='Minutes between ticks.',
+        action="store", type=int, default=5)
+    parser.add_argument(
+        '--late',
+        help='Share of ticks followed by a delay of 2-6 intervals.',
+        action="store", type=float, default=0.05)
+    parser.add_argument(
+        '--cold-start',
+        help='Share of ticks that start with an empty index.',
+        action="store", type=float, default=0.05)
+    parser.add_argument(
+        '--manual',
+        help='Instances started or stopped by hand before every tick.',
+        action="store", type=int, default=20)
+    parser.add_argument(
+        '--seed',
+        help='Random seed.',
+        action="store", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        stats, tick_time, calls = simulate(args, workdir)
+    print(f"{stats['ticks']} ticks ({stats['cold']} cold, {stats['late']} late), "
+          f"{stats['changed']} instances changed, {tick_time / stats['ticks'] * 1000:.1f} ms per tick")
+    print('API calls: ' + ', '.join(f'{name} {count}' for name, count in sorted(calls.items())))
+    print(f"{stats['errors']} mismatches")
+    return 1 if stats['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
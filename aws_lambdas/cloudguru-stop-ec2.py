@@ -1,40 +1,91 @@
-#!/usr/bin/python
-import boto3
+#!/usr/bin/env python3
+import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+from aws_clients import get_client
+from ec2_batches import change_batch
 
 #setup simple logging for INFO
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-#define the connection
-ec2 = boto3.resource('ec2')
+# Instance IDs per stop_instances call
+STOP_BATCH_SIZE = 100
+MAX_WORKERS = 20
+# short timeouts and few retries keep a slow region from holding the sweep
+config = Config(connect_timeout=5, read_timeout=10, retries={'max_attempts': 3, 'mode': 'standard'})
+
+# running instances with an empty Name tag
+filters = [{
+        'Name': 'tag:Name',
+        'Values': ['']
+    },
+    {
+        'Name': 'instance-state-name',
+        'Values': ['running']
+    }
+]
+
+
+def get_regions():
+    # describe_regions returns only the regions enabled for the account
+    client = get_client('ec2', config=config)
+    return sorted(region['RegionName'] for region in client.describe_regions()['Regions'])
+
+
+def stop_region(client, dry_run=False):
+    region = client.meta.region_name
+    summary = {'running': 0, 'stopped': [], 'failed': [], 'errors': {}}
+    try:
+        instance_ids = []
+        paginator = client.get_paginator('describe_instances')
+        for page in paginator.paginate(Filters=filters, PaginationConfig={'PageSize': 1000}):
+            for reservation in page['Reservations']:
+                instance_ids += [instance['InstanceId'] for instance in reservation['Instances']]
+    except (BotoCoreError, ClientError) as err:
+        summary['error'] = str(err)
+        return region, summary
+
+    summary['running'] = len(instance_ids)
+    for i in range(0, len(instance_ids), STOP_BATCH_SIZE):
+        batch = instance_ids[i:i + STOP_BATCH_SIZE]
+        if dry_run:
+            summary['stopped'] += batch
+            continue
+        stopped, failed = change_batch(client.stop_instances, batch)
+        summary['stopped'] += stopped
+        for instance_id, err in failed:
+            summary['failed'].append(instance_id)
+            summary['errors'][instance_id] = err
+    return region, summary
+
 
 def lambda_handler(event, context):
-    # Use the filter() method of the instances collection to retrieve
-    # all running EC2 instances.
-    filters = [{
-            'Name': 'tag:Name',
-            'Values': ['']
-        },
-        {
-            'Name': 'instance-state-name',
-            'Values': ['running']
-        }
-    ]
-
-    #filter the instances
-    instances = ec2.instances.filter(Filters=filters)
-
-    #locate all running instances
-    RunningInstances = [instance.id for instance in instances]
-
-    #print the instances for logging purposes
-    #print RunningInstances
-
-    #make sure there are actually instances to shut down.
-    if len(RunningInstances) > 0:
-        #perform the shutdown
-        shuttingDown = ec2.instances.filter(InstanceIds=RunningInstances).stop()
-        print shuttingDown
-    else:
-        print "Nothing to see here"
+    # "dry_run": true only reports the instances that would be stopped
+    dry_run = bool((event or {}).get('dry_run'))
+    # clients are created in one thread, the shared session loads the
+    # service model once and warm invocations reuse the clients
+    clients = [get_client('ec2', region_name=region, config=config) for region in get_regions()]
+
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(clients))) as executor:
+        summaries = dict(executor.map(lambda client: stop_region(client, dry_run), clients))
+
+    for region, summary in summaries.items():
+        if summary.get('error'):
+            logger.error(region + ": " + summary['error'])
+        for instance_id, err in summary['errors'].items():
+            logger.error(region + ": " + instance_id + " was not stopped: " + err)
+        if summary['stopped']:
+            logger.info(region + ": " + ("would stop " if dry_run else "stopped ")
+                        + ", ".join(summary['stopped']))
+    total = sum(len(summary['stopped']) for summary in summaries.values())
+    if not total:
+        logger.info("Nothing to see here")
+    logger.info(json.dumps({region: {key: len(value) if isinstance(value, (list, dict)) else value
+                                     for key, value in summary.items()}
+                            for region, summary in summaries.items()}))
+    return summaries
@@ -0,0 +1,19 @@
+from botocore.exceptions import BotoCoreError, ClientError
+
+
+# Calls api_call (e.g. client.stop_instances) for a batch of instance IDs at
+# once. A failed call is split in halves down to single instances, so one
+# instance that can't be changed doesn't block the others of the batch and
+# costs a few calls instead of one call per instance.
+# Returns the changed IDs and a list of (instance_id, error).
+def change_batch(api_call, instance_ids):
+    try:
+        api_call(InstanceIds=instance_ids)
+        return instance_ids, []
+    except (BotoCoreError, ClientError) as err:
+        if len(instance_ids) == 1:
+            return [], [(instance_ids[0], str(err))]
+    half = len(instance_ids) // 2
+    changed, failed = change_batch(api_call, instance_ids[:half])
+    other_changed, other_failed = change_batch(api_call, instance_ids[half:])
+    return changed + other_changed, failed + other_failed
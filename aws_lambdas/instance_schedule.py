@@ -0,0 +1,233 @@
+import heapq
+from datetime import datetime, time as dtime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+# Schedules read from the Schedule tag of instances by instance_scheduler.py.
+# Two forms are accepted:
+#   office hours -- "08:00-18:00", "08:00-18:00 mon-fri",
+#                   "08:00-18:00 mon-fri Europe/Kyiv", "22:00-06:00 mon,wed"
+#                   (start and stop every listed day, days default to every day)
+#   cron         -- "start=0 8 * * 1-5; stop=0 18 * * 1-5; tz=Europe/Kyiv"
+#                   (5 field cron expressions, start or stop can be omitted)
+# The timezone defaults to UTC.
+#
+# The ScheduleIndex keeps one entry per instance in a heap keyed by the next
+# transition time of its schedule. A tick pops the entries that are due, so
+# its cost depends on the number of transitions, not on the number of
+# instances. Schedules are compiled once per distinct tag value. Entries of
+# new and changed instances start at the time of the previous tick, so a
+# cold start or a late tick runs the transitions since then exactly once.
+
+DAY_NAMES = ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']
+MONTH_NAMES = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+# a cron expression for February 29 may need 8 years to match
+MAX_DAYS = 366 * 8
+
+
+def parse_value(text, names, offset):
+    if names and text[:3].lower() in names:
+        return names.index(text[:3].lower()) + offset
+    return int(text)
+
+
+def parse_field(text, low, high, names=None):
+    # month names start at 1, day names at 0
+    offset = low if names else 0
+    values = set()
+    for part in text.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/')
+            step = int(step)
+        if part == '*':
+            first, last = low, high
+        elif '-' in part:
+            first, last = (parse_value(value, names, offset) for value in part.split('-'))
+        else:
+            first = parse_value(part, names, offset)
+            last = high if step > 1 else first
+        if step < 1 or not (low <= first <= high and low <= last <= high):
+            raise ValueError('Value out of range in "' + text + '"')
+        if first <= last:
+            values.update(range(first, last + 1, step))
+        else:
+            # wrapping ranges like fri-mon
+            values.update(range(first, high + 1, step))
+            values.update(range(low, last + 1, step))
+    return values
+
+
+# day of week fields accept 0-7, 0 and 7 are Sunday
+def parse_weekdays(text):
+    return {day % 7 for day in parse_field(text, 0, 7, DAY_NAMES)}
+
+
+def parse_time(text):
+    hour, minute = (int(value) for value in text.split(':'))
+    return dtime(hour, minute)
+
+
+class CronExpression:
+    def __init__(self, minutes, hours, days, months, weekdays, any_day=True, any_weekday=True):
+        self.minutes = sorted(minutes)
+        self.hours = sorted(hours)
+        self.days = days
+        self.months = months
+        self.weekdays = weekdays
+        self.any_day = any_day
+        self.any_weekday = any_weekday
+
+    @classmethod
+    def parse(cls, text):
+        fields = text.split()
+        if len(fields) != 5:
+            raise ValueError('Cron expression needs 5 fields: "' + text + '"')
+        minute, hour, day, month, weekday = fields
+        return cls(parse_field(minute, 0, 59), parse_field(hour, 0, 23),
+                   parse_field(day, 1, 31), parse_field(month, 1, 12, MONTH_NAMES),
+                   parse_weekdays(weekday), day == '*', weekday == '*')
+
+    def day_matches(self, day):
+        if day.month not in self.months:
+            return False
+        day_match = day.day in self.days
+        # cron weekday 0 is Sunday, date.weekday() 0 is Monday
+        weekday_match = (day.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day_match and weekday_match
+        return day_match or weekday_match
+
+    # first matching time after the given time, in UTC
+    def next_after(self, after, tz):
+        local = after.astimezone(tz).replace(second=0, microsecond=0, tzinfo=None) + timedelta(minutes=1)
+        day = local.date()
+        for _ in range(MAX_DAYS):
+            if self.day_matches(day):
+                today = day == local.date()
+                for hour in self.hours:
+                    if today and hour < local.hour:
+                        continue
+                    for minute in self.minutes:
+                        if today and hour == local.hour and minute < local.minute:
+                            continue
+                        when = datetime.combine(day, dtime(hour, minute), tzinfo=tz).astimezone(timezone.utc)
+                        # local times repeated or skipped by DST changes
+                        if when > after:
+                            return when
+            day += timedelta(days=1)
+        return None
+
+
+class Schedule:
+    def __init__(self, starts, stops, tz):
+        self.starts = starts
+        self.stops = stops
+        self.tz = tz
+
+    @classmethod
+    def parse(cls, text):
+        text = text.strip()
+        if '=' in text:
+            return cls.parse_cron(text)
+        return cls.parse_office_hours(text)
+
+    @classmethod
+    def parse_cron(cls, text):
+        starts, stops, tz = [], [], timezone.utc
+        for item in text.split(';'):
+            if not item.strip():
+                continue
+            key, value = (part.strip() for part in item.split('=', 1))
+            if key == 'start':
+                starts.append(CronExpression.parse(value))
+            elif key == 'stop':
+                stops.append(CronExpression.parse(value))
+            elif key == 'tz':
+                tz = ZoneInfo(value)
+            else:
+                raise ValueError('Unknown schedule field "' + key + '"')
+        if not starts and not stops:
+            raise ValueError('Schedule without start or stop: "' + text + '"')
+        return cls(starts, stops, tz)
+
+    @classmethod
+    def parse_office_hours(cls, text):
+        tokens = text.split()
+        start, stop = (parse_time(value) for value in tokens[0].split('-'))
+        weekdays, tz = set(range(7)), timezone.utc
+        for token in tokens[1:]:
+            if token[:3].lower() in DAY_NAMES:
+                weekdays = parse_weekdays(token)
+            else:
+                tz = ZoneInfo(token)
+        # overnight hours stop on the following day
+        stop_weekdays = weekdays if stop > start else {(day + 1) % 7 for day in weekdays}
+        every_day, every_month = set(range(1, 32)), set(range(1, 13))
+        return cls(
+            [CronExpression({start.minute}, {start.hour}, every_day, every_month, weekdays)],
+            [CronExpression({stop.minute}, {stop.hour}, every_day, every_month, stop_weekdays)],
+            tz)
+
+    # (time, action) of the first transition after the given time
+    def next_transition(self, after):
+        transitions = [(expression.next_after(after, self.tz), action)
+                       for action, expressions in (('start', self.starts), ('stop', self.stops))
+                       for expression in expressions]
+        transitions = [transition for transition in transitions if transition[0]]
+        return min(transitions) if transitions else None
+
+
+class ScheduleIndex:
+    def __init__(self):
+        self.compiled = {}
+        self.instances = {}
+        self.heap = []
+        self.errors = []
+
+    def compile(self, text):
+        if text not in self.compiled:
+            try:
+                self.compiled[text] = Schedule.parse(text)
+            except (ValueError, KeyError, IndexError) as err:
+                self.compiled[text] = None
+                self.errors.append((text, str(err)))
+        return self.compiled[text]
+
+    def push(self, instance_id, text, after):
+        schedule = self.compile(text)
+        transition = schedule and schedule.next_transition(after)
+        if transition:
+            heapq.heappush(self.heap, (transition[0], instance_id, text, transition[1]))
+
+    # instance_schedules is {instance_id: tag value} of the current scan,
+    # new and changed instances get the transitions after since, the time
+    # of the previous tick. Returns the tag values that could not be parsed.
+    def update(self, instance_schedules, since):
+        self.errors = []
+        for instance_id in list(self.instances):
+            if instance_id not in instance_schedules:
+                del self.instances[instance_id]
+        for instance_id, text in instance_schedules.items():
+            if self.instances.get(instance_id) != text:
+                self.instances[instance_id] = text
+                self.push(instance_id, text, since)
+        # entries of removed and changed instances are dropped when popped,
+        # the heap is rebuilt when they outnumber the live ones
+        if len(self.heap) > 2 * len(self.instances) + 64:
+            self.heap = [entry for entry in self.heap if self.instances.get(entry[1]) == entry[2]]
+            heapq.heapify(self.heap)
+        return self.errors
+
+    # {instance_id: action} of the transitions due at now, the last one wins
+    def tick(self, now):
+        actions = {}
+        while self.heap and self.heap[0][0] <= now:
+            when, instance_id, text, action = heapq.heappop(self.heap)
+            if self.instances.get(instance_id) != text:
+                continue
+            actions[instance_id] = action
+            self.push(instance_id, text, when)
+        return actions
+
+    def next_tick(self):
+        return self.heap[0][0] if self.heap else None
@@ -1,7 +1,14 @@
 import logging
+import os
 import time
+from datetime import datetime, timedelta, timezone
 import boto3
 import botocore
+from botocore.exceptions import ClientError
+
+from aws_clients import get_client
+from ec2_batches import change_batch
+from instance_schedule import ScheduleIndex
 
 # Logging configuration for running in cloud and local development
 if len(logging.getLogger().handlers) > 0:
@@ -13,38 +20,239 @@ else:
 
 
 region = 'eu-central-1'
-ec2 = boto3.resource('ec2')
-ssm = boto3.client('ssm')
+
+# Instance IDs per start/stop call and per describe_instances filter
+INSTANCE_BATCH_SIZE = 100
+WAIT_TIMEOUT = 300
+POLL_INTERVAL = 10
+# seconds kept free before the Lambda timeout when waiting
+TIMEOUT_MARGIN = 15
+# get_parameters accepts up to 10 names per call
+PARAMETER_BATCH_SIZE = 10
+# SSM values are reused by warm invocations for this many seconds
+PARAMETER_CACHE_TTL = int(os.environ.get('PARAMETER_CACHE_TTL', 300))
+
+# {name: (value, read_at)} and {path: (names, read_at)} kept across warm invocations
+parameter_cache = {}
+path_cache = {}
+
+SCHEDULE_TAG = 'Schedule'
+# compiled schedules and their next transitions, kept across warm invocations
+schedule_index = ScheduleIndex()
+# a tick after a longer pause runs only the transitions of this last period
+SCHEDULE_MAX_CATCHUP = timedelta(hours=1)
+# The time of the last tick is kept in the SSM parameter SCHEDULE_STATE_PARAMETER,
+# or in the local file SCHEDULE_STATE_FILE when the parameter is not set
+
+ACTIONS = {
+    "start": ("start_instances", "started", "running"),
+    "stop": ("stop_instances", "stopped", "stopped"),
+}
+
+
+def is_fresh(cache, key):
+    return key in cache and time.monotonic() - cache[key][1] < PARAMETER_CACHE_TTL
+
+
+def parse_instances(value):
+    return [instance_id for instance_id in value.replace(" ", "").split(",") if instance_id]
+
+
+def read_parameters(names):
+    # {name: value} for the names, SSM is read only for the missing or expired
+    # ones. Deleted parameters are evicted, so a warm container doesn't keep
+    # scheduling a group that no longer exists.
+    missing = [name for name in dict.fromkeys(names) if not is_fresh(parameter_cache, name)]
+    fetched = set()
+    for i in range(0, len(missing), PARAMETER_BATCH_SIZE):
+        response = get_client('ssm').get_parameters(Names=missing[i:i + PARAMETER_BATCH_SIZE], WithDecryption=True)
+        for parameter in response['Parameters']:
+            parameter_cache[parameter['Name']] = (parameter['Value'], time.monotonic())
+            fetched.add(parameter['Name'])
+        for name in response['InvalidParameters']:
+            parameter_cache.pop(name, None)
+            logging.warning("SSM parameter " + name + " not found")
+    return {name: parameter_cache[name][0] for name in names
+            if name in fetched or is_fresh(parameter_cache, name)}
+
+
+def read_parameter_path(path):
+    # parameter names under the path, their values are cached with the names
+    if not is_fresh(path_cache, path):
+        names = []
+        paginator = get_client('ssm').get_paginator('get_parameters_by_path')
+        for page in paginator.paginate(Path=path, Recursive=True, WithDecryption=True):
+            for parameter in page['Parameters']:
+                parameter_cache[parameter['Name']] = (parameter['Value'], time.monotonic())
+                names.append(parameter['Name'])
+        path_cache[path] = (names, time.monotonic())
+    return read_parameters(path_cache[path][0])
 
 
 def get_instances(ssm_parameter):
-    response = ssm.get_parameter(Name=ssm_parameter, WithDecryption=True)
-    return (response['Parameter']['Value']).replace(" ", "").split(",")
+    return parse_instances(read_parameters([ssm_parameter]).get(ssm_parameter, ""))
+
+
+def get_instance_groups(event):
+    # {parameter_name: [instance_id, ...]} for "instance_parameter" (a name or
+    # a list of names) and "instance_parameter_path" (a path prefix)
+    names = event.get("instance_parameter") or []
+    if isinstance(names, str):
+        names = [names]
+    values = read_parameters(names)
+    if event.get("instance_parameter_path"):
+        values.update(read_parameter_path(event["instance_parameter_path"]))
+    return {name: parse_instances(value) for name, value in values.items()}
 
 
 def change_instance_state(ec2_instances, event):
-    for instance_id in ec2_instances:
-        instance = ec2.Instance(instance_id)
-        if event["action"] is not None:
-            if event["action"] == "start":
-                instance.start()
-                logging.info("Instance " + instance_id + " was started")
-            elif event["action"] == "stop":
-                instance.stop()
-                logging.info("Instance " + instance_id + " was stopped")
-            else:
-                logging.info("Unsupported action type was passed to script: " + event["action"])
+    if event["action"] not in ACTIONS:
+        logging.info("Unsupported action type was passed to script: " + str(event["action"]))
+        return [], []
+    method, done, _ = ACTIONS[event["action"]]
+    api_call = getattr(get_client('ec2'), method)
+    changed = []
+    failed = []
+    for i in range(0, len(ec2_instances), INSTANCE_BATCH_SIZE):
+        batch_changed, batch_failed = change_batch(api_call, ec2_instances[i:i + INSTANCE_BATCH_SIZE])
+        for instance_id in batch_changed:
+            logging.info("Instance " + instance_id + " was " + done)
+        for instance_id, err in batch_failed:
+            logging.error("Instance " + instance_id + " was not " + done + ": " + err)
+        changed += batch_changed
+        failed += batch_failed
+    return changed, failed
+
+
+def describe_instances(ec2_instances):
+    # {instance_id: (state, instance_type)} read with paginated filtered calls
+    paginator = get_client('ec2').get_paginator('describe_instances')
+    instances = {}
+    for i in range(0, len(ec2_instances), INSTANCE_BATCH_SIZE):
+        for page in paginator.paginate(
+                Filters=[{'Name': 'instance-id', 'Values': ec2_instances[i:i + INSTANCE_BATCH_SIZE]}],
+                PaginationConfig={'PageSize': 1000}):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    instances[instance['InstanceId']] = (instance['State']['Name'], instance['InstanceType'])
+    return instances
 
 
 def get_instance_status(ec2_instances):
+    instances = describe_instances(ec2_instances)
     logging.info(70*"-")
     for instance_id in ec2_instances:
-        instance = ec2.Instance(instance_id)
+        if instance_id not in instances:
+            logging.info("Instance " + instance_id + " not found")
+            continue
+        state, instance_type = instances[instance_id]
         logging.info("Instance " + instance_id
-                     + " in " + instance.state['Name']
+                     + " in " + state
                      + " state, instance type: "
-                     + instance.instance_type)
+                     + instance_type)
     logging.info(70*"-")
+    return instances
+
+
+def wait_for_state(ec2_instances, target_state, deadline):
+    # polls all instances together until they reach the target state or the
+    # deadline passes, returns the instances still in another state
+    pending = list(ec2_instances)
+    while True:
+        instances = describe_instances(pending)
+        pending = [instance_id for instance_id in pending
+                   if instances.get(instance_id, (None,))[0] != target_state]
+        if not pending:
+            logging.info("All instances are " + target_state)
+            return []
+        if time.monotonic() + POLL_INTERVAL > deadline:
+            logging.warning("Instances not " + target_state + " before the deadline: " + ", ".join(pending))
+            return pending
+        logging.info(str(len(pending)) + " instances are not " + target_state + " yet")
+        time.sleep(POLL_INTERVAL)
+
+
+def get_deadline(event, context):
+    timeout = float(event.get("wait_timeout", WAIT_TIMEOUT))
+    if hasattr(context, 'get_remaining_time_in_millis'):
+        timeout = min(timeout, context.get_remaining_time_in_millis() / 1000 - TIMEOUT_MARGIN)
+    return time.monotonic() + timeout
+
+
+def clock():
+    return datetime.now(timezone.utc)
+
+
+def load_last_tick():
+    # time of the previous schedule tick, None before the first one
+    raw = None
+    if os.environ.get('SCHEDULE_STATE_PARAMETER'):
+        try:
+            raw = get_client('ssm').get_parameter(Name=os.environ['SCHEDULE_STATE_PARAMETER'])['Parameter']['Value']
+        except ClientError as err:
+            logging.warning("Cannot read the last schedule tick: " + str(err))
+    elif os.environ.get('SCHEDULE_STATE_FILE') and os.path.exists(os.environ['SCHEDULE_STATE_FILE']):
+        with open(os.environ['SCHEDULE_STATE_FILE']) as f:
+            raw = f.read()
+    return datetime.fromisoformat(raw.strip()) if raw else None
+
+
+def save_last_tick(now):
+    # the instances are changed already, a failed write only makes the next
+    # cold start take the transitions of a longer period
+    try:
+        if os.environ.get('SCHEDULE_STATE_PARAMETER'):
+            get_client('ssm').put_parameter(Name=os.environ['SCHEDULE_STATE_PARAMETER'], Value=now.isoformat(),
+                                            Type='String', Overwrite=True)
+        elif os.environ.get('SCHEDULE_STATE_FILE'):
+            with open(os.environ['SCHEDULE_STATE_FILE'], 'w') as f:
+                f.write(now.isoformat())
+    except (ClientError, OSError) as err:
+        logging.error("Cannot save the last schedule tick: " + str(err))
+
+
+def scan_scheduled_instances(tag_key):
+    # {instance_id: (schedule, state)} of all instances with the schedule tag
+    paginator = get_client('ec2').get_paginator('describe_instances')
+    instances = {}
+    for page in paginator.paginate(
+            Filters=[
+                {'Name': 'tag-key', 'Values': [tag_key]},
+                {'Name': 'instance-state-name', 'Values': ['pending', 'running', 'stopping', 'stopped']}
+            ],
+            PaginationConfig={'PageSize': 1000}):
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                tags = {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
+                instances[instance['InstanceId']] = (tags[tag_key], instance['State']['Name'])
+    return instances
+
+
+def run_schedule(event, context):
+    # one tick of the tag driven schedule, meant to run every few minutes
+    now = clock()
+    # new and changed instances take the transitions since the last tick,
+    # the first tick only the ones after it
+    last_tick = load_last_tick()
+    since = max(last_tick, now - SCHEDULE_MAX_CATCHUP) if last_tick else now
+    tag_key = event.get("schedule_tag", SCHEDULE_TAG)
+    instances = scan_scheduled_instances(tag_key)
+    errors = schedule_index.update(
+        {instance_id: schedule for instance_id, (schedule, _) in instances.items()}, since)
+    for schedule, err in errors:
+        logging.warning("Invalid " + tag_key + " tag " + schedule + ": " + err)
+    actions = schedule_index.tick(now)
+    # only instances not already in the target state are changed
+    start = sorted(instance_id for instance_id, action in actions.items()
+                   if action == "start" and instances[instance_id][1] in ("stopped", "stopping"))
+    stop = sorted(instance_id for instance_id, action in actions.items()
+                  if action == "stop" and instances[instance_id][1] in ("pending", "running"))
+    logging.info(str(len(instances)) + " scheduled instances, " + str(len(start)) + " to start, "
+                 + str(len(stop)) + " to stop")
+    started, _ = change_instance_state(start, {"action": "start"})
+    stopped, _ = change_instance_state(stop, {"action": "stop"})
+    save_last_tick(now)
+    return {'started': started, 'stopped': stopped}
 
 
 def main(event, context):
@@ -52,19 +260,31 @@ def main(event, context):
     logging.info("botocore version:" + botocore.__version__)
     logging.info("AWS region:" + region)
 
-    instance_parameter_name = event["instance_parameter"]
+    # "action": "schedule" starts and stops instances according to their
+    # Schedule tag, see instance_schedule.py for the tag syntax
+    if event["action"] == "schedule":
+        return run_schedule(event, context)
 
-    ec2_instances = get_instances(instance_parameter_name)
+    instance_groups = get_instance_groups(event)
 
     logging.info("Action is " + event["action"])
-    logging.info("List of EC2 instance: ")
-    logging.info(ec2_instances)
+    for name, group_instances in instance_groups.items():
+        logging.info("List of EC2 instance in " + name + ": ")
+        logging.info(group_instances)
+    # all groups are changed together, an instance in several groups once
+    ec2_instances = list(dict.fromkeys(
+        instance_id for group_instances in instance_groups.values() for instance_id in group_instances))
 
-    change_instance_state(ec2_instances, event)
-#    time.sleep(20)
+    changed, failed = change_instance_state(ec2_instances, event)
+    # "wait": true polls the changed instances until they reach the target
+    # state, at most "wait_timeout" seconds and within the Lambda timeout
+    if event.get("wait") and changed:
+        wait_for_state(changed, ACTIONS[event["action"]][2], get_deadline(event, context))
     get_instance_status(ec2_instances)
 
 
 ## use it for local development
 # if __name__ == '__main__':
 #     main(event={"action": "stop", "instance_parameter": "eks_worker_instances"}, context=2)
+#     main(event={"action": "start", "instance_parameter_path": "/scheduler/dev/", "wait": True}, context=2)
+#     main(event={"action": "schedule"}, context=2)
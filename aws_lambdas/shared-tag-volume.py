@@ -1,56 +1,172 @@
+import json
 import logging
 import os
 import os.path
-import re
 import sys
-from datetime import datetime, timedelta
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
 import boto3
 import botocore
+from botocore.exceptions import ClientError
 
-logging.basicConfig(level=logging.INFO)
+from aws_clients import get_client
+from volume_tag_rules import VolumeTagRules, apply_plan
 
-os.environ['IGNORE_WINDOW'] = '4'
-os.environ['DETAILED_NOTIFICATIONS'] = 'True'
-os.environ['AWS_REGION'] = 'eu-central-1'
+logging.basicConfig(level=logging.INFO)
 
-ec2 = boto3.resource('ec2')
-sns = boto3.client('sns')
+# Defaults of the environment variables, the environment itself is not
+# changed at import time. Clients are created on first use by aws_clients.
+DEFAULT_ENVIRONMENT = {
+    'IGNORE_WINDOW': '4',
+    'DETAILED_NOTIFICATIONS': 'True',
+    'AWS_REGION': 'eu-central-1',
+}
 
+rules = VolumeTagRules.from_file(os.environ.get('TAG_RULE_SET', 'shared_tag_volume'))
 
+# Values per describe_volumes filter
+DESCRIBE_BATCH_SIZE = 200
+# LookupEvents is limited to 2 requests per second per account and region
+LOOKUP_INTERVAL = 0.5
+# Events can show up in LookupEvents minutes after their event time, so every
+# run re-reads this overlap and skips events already seen by their ID
+CURSOR_OVERLAP = timedelta(minutes=15)
+# A Standard tier SSM parameter holds 4096 characters. A cursor with more
+# overlap event IDs than fit is saved with its time only.
+CURSOR_MAX_SIZE = 4096
 
-projects = ["test","control-plane"]
+lookup_lock = threading.Lock()
+last_lookup = [0.0]
 
 
 ## Usage Notes:
 ### environment variables:
 #### IGNORE_WINDOW -- volumes with activity in this window will be ignored even if they are available; e.g. for a 30 day IGNORE_WINDOW, a volume detached 29 days ago will not be flagged, but a volume detached 31 days ago will. Value must be between 1 and 90
 #### DETAILED_NOTIFICATIONS -- TRUE/FALSE, determines if detailed notifications are sent to SNS_ARN with the list of volumes found
+#### CURSOR_PARAMETER -- optional SSM parameter name that stores the CloudTrail cursor, so each run reads only new events
+#### CURSOR_FILE -- optional local file for the CloudTrail cursor, used when CURSOR_PARAMETER is not set
+#### BACKFILL_SLICES -- number of time slices read concurrently when the whole IGNORE_WINDOW is read, default 1; calls of all slices share the LookupEvents rate
+
+
+def getEnv(name):
+    return os.environ.get(name, DEFAULT_ENVIRONMENT[name])
 
 
 def validateEnvironmentVariables():
-    if (int(os.environ["IGNORE_WINDOW"]) < 1 or int(os.environ["IGNORE_WINDOW"]) > 90):
+    if (int(getEnv("IGNORE_WINDOW")) < 1 or int(getEnv("IGNORE_WINDOW")) > 90):
         logging.warning("Invalid value provided for IGNORE_WINDOW. Please choose a value between 1 day and 90 days.")
         raise ValueError('Bad IGNORE_WINDOW value provided')
-    if (os.environ["DETAILED_NOTIFICATIONS"].upper() not in ["TRUE", "FALSE"]):
+    if (getEnv("DETAILED_NOTIFICATIONS").upper() not in ["TRUE", "FALSE"]):
         logging.warning("Invalid value provided for DETAILED_NOTIFICATIONS. Please choose TRUE or FALSE.")
         raise ValueError('Bad DETAILED_NOTIFICATIONS value provided')
 
 
-def getCloudTrailEvents(start_date_time, rgn):
-    # gets CloudTrail events from start_date_time until "now"
-    cloudTrail = boto3.client('cloudtrail', region_name=rgn)
+def waitForLookup():
+    # reserves the next LookupEvents slot, LOOKUP_INTERVAL after the previous
+    # one, and waits for it outside the lock. Calls of several threads start
+    # at the allowed rate and their latencies overlap.
+    with lookup_lock:
+        slot = max(time.monotonic(), last_lookup[0] + LOOKUP_INTERVAL)
+        last_lookup[0] = slot
+    delay = slot - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+
+def getCloudTrailEvents(start_date_time, rgn, end_date_time=None):
+    # gets CloudTrail events from start_date_time until end_date_time or "now"
+    cloudTrail = get_client('cloudtrail', region_name=rgn)
     attrList = [{'AttributeKey': 'ResourceType', 'AttributeValue': 'AWS::EC2::Volume'}]
+    timeRange = {'StartTime': start_date_time}
+    if end_date_time:
+        timeRange['EndTime'] = end_date_time
     eventList = []
-    response = cloudTrail.lookup_events(LookupAttributes=attrList, StartTime=start_date_time, MaxResults=50)
+    waitForLookup()
+    response = cloudTrail.lookup_events(LookupAttributes=attrList, MaxResults=50, **timeRange)
     eventList += response['Events']
     while ('NextToken' in response):
-        response = cloudTrail.lookup_events(LookupAttributes=attrList, StartTime=start_date_time, MaxResults=50,
-                                            NextToken=response['NextToken'])
+        waitForLookup()
+        response = cloudTrail.lookup_events(LookupAttributes=attrList, MaxResults=50,
+                                            NextToken=response['NextToken'], **timeRange)
         eventList += response['Events']
     return eventList
 
 
+def backfillCloudTrailEvents(start_date_time, end_date_time, rgn, slices):
+    # reads the window as time slices in parallel, calls stay within the lookup rate
+    if slices <= 1:
+        return getCloudTrailEvents(start_date_time, rgn)
+    step = (end_date_time - start_date_time) / slices
+    bounds = [(start_date_time + step * i, start_date_time + step * (i + 1)) for i in range(slices)]
+    # the last slice is open ended to catch events arriving during the run
+    bounds[-1] = (bounds[-1][0], None)
+    eventList = []
+    with ThreadPoolExecutor(max_workers=slices) as executor:
+        futures = [executor.submit(getCloudTrailEvents, start, rgn, end) for start, end in bounds]
+        for future in futures:
+            eventList += future.result()
+    return eventList
+
+
+def loadCursor():
+    # returns event time and IDs of the events seen last time, the IDs are
+    # None for a cursor saved with its time only
+    raw = None
+    if os.environ.get('CURSOR_PARAMETER'):
+        try:
+            ssm = get_client('ssm', region_name=getEnv("AWS_REGION"))
+            raw = ssm.get_parameter(Name=os.environ['CURSOR_PARAMETER'])['Parameter']['Value']
+        except ClientError as err:
+            logging.warning("Cannot read CloudTrail cursor: " + str(err))
+    elif os.environ.get('CURSOR_FILE') and os.path.exists(os.environ['CURSOR_FILE']):
+        with open(os.environ['CURSOR_FILE']) as f:
+            raw = f.read()
+    if not raw:
+        return None, set()
+    cursor = json.loads(raw)
+    event_ids = cursor.get('event_ids')
+    return datetime.fromisoformat(cursor['event_time']), None if event_ids is None else set(event_ids)
+
+
+def saveCursor(events, cursor_time, cursor_ids):
+    # keeps the newest event time and the IDs of events inside the overlap
+    times = [e['EventTime'] for e in events]
+    if cursor_time:
+        times.append(cursor_time)
+    if not times:
+        return
+    event_time = max(times)
+    event_ids = set(e['EventId'] for e in events if e['EventTime'] >= event_time - CURSOR_OVERLAP)
+    if cursor_time and cursor_ids and cursor_time >= event_time - CURSOR_OVERLAP:
+        event_ids |= cursor_ids
+    raw = json.dumps({'event_time': event_time.isoformat(), 'event_ids': sorted(event_ids)})
+    if len(raw) > CURSOR_MAX_SIZE:
+        # time only: the next run skips overlap events up to event_time,
+        # events delivered late inside the overlap can be missed
+        logging.warning(str(len(event_ids)) + " overlap event IDs don't fit the cursor, it is saved with its time only")
+        raw = json.dumps({'event_time': event_time.isoformat(), 'event_ids': None})
+    # the volumes are tagged already, a failed write only makes the next
+    # run read more events
+    try:
+        if os.environ.get('CURSOR_PARAMETER'):
+            ssm = get_client('ssm', region_name=getEnv("AWS_REGION"))
+            ssm.put_parameter(Name=os.environ['CURSOR_PARAMETER'], Value=raw, Type='String', Overwrite=True)
+        elif os.environ.get('CURSOR_FILE'):
+            with open(os.environ['CURSOR_FILE'], 'w') as f:
+                f.write(raw)
+    except (ClientError, OSError) as err:
+        logging.error("Cannot save CloudTrail cursor: " + str(err))
+
+
+def getNewEvents(events, cursor_time, cursor_ids):
+    if cursor_ids is None:
+        return [e for e in events if e['EventTime'] > cursor_time]
+    return [e for e in events if e['EventId'] not in cursor_ids]
+
+
 def getRecentActiveVolumes(events):
     # parses volumes from list of events from CloudTrail
     active_volume_list = []
@@ -62,53 +178,63 @@ def getRecentActiveVolumes(events):
     return active_volume_set
 
 
-def validate_user_tag(volumes):
-    for volume in volumes:
+def get_volume_tags(volumes):
+    # resolves tags of all volumes with chunked describe_volumes calls
+    # volume-id filter skips deleted volumes instead of failing the whole call
+    client = get_client('ec2', region_name=getEnv("AWS_REGION"))
+    paginator = client.get_paginator('describe_volumes')
+    volumes = list(volumes)
+    tag_map = {}
+    for i in range(0, len(volumes), DESCRIBE_BATCH_SIZE):
+        chunk = volumes[i:i + DESCRIBE_BATCH_SIZE]
         try:
-            tags = {}
-            for tag in ec2.Volume(id=volume).tags:
-                tags[tag['Key']] = tag['Value']
-            if ('user:tag' not in tags) and ('kubernetes.io/created-for/pvc/namespace' in tags) and ('kubernetes.io/cluster/shared' in tags):
-                user_tag = get_usertag(volume)
-                if not user_tag:
-                    logging.info("Volume " + str(volume) + " won't be tagged user:tag is empty")
-                    continue
-                tag_volume(volume, user_tag + '-eks')
-        except TypeError as t_err:
-            pass
-            #logging.warning("Volume " + volume + " hasn't any tags. Exception: " + str(t_err))
-        except Exception as err:
-            pass
-            #logging.warning(err)
+            for page in paginator.paginate(Filters=[{'Name': 'volume-id', 'Values': chunk}]):
+                for volume in page['Volumes']:
+                    tag_map[volume['VolumeId']] = {tag['Key']: tag['Value'] for tag in volume.get('Tags', [])}
+        except ClientError as err:
+            logging.warning("Cannot describe volumes " + ", ".join(chunk) + ": " + str(err))
+    return tag_map
 
 
-def tag_volume(volume, user_tag):
-    volume = ec2.Volume(id=volume)
-    volume.create_tags(Tags=[{'Key': 'user:tag', 'Value': user_tag }])
-    logging.warning("Volume " + str(volume) + " tagged by user:tag " + user_tag)
+def validate_user_tag(volumes):
+    tag_map = get_volume_tags(volumes)
+    tag_plan = {}
+    for volume, tags in tag_map.items():
+        if rules.target_tag in tags:
+            logging.info("Volume " + volume + " has already been tagged by user:tag " + tags[rules.target_tag])
+            continue
+        user_tag = get_usertag(volume, tags)
+        if not user_tag:
+            logging.info("Volume " + str(volume) + " won't be tagged user:tag is empty")
+            continue
+        tag_plan.setdefault((rules.target_tag, user_tag), []).append(volume)
+    tag_volumes(tag_plan)
+
+
+def tag_volumes(tag_plan):
+    # applies a tagging plan {(key, value): [volume_id, ...]} with bulk calls
+    tagged, failed = apply_plan(get_client('ec2', region_name=getEnv("AWS_REGION")), tag_plan)
+    for volume_id, key, value in tagged:
+        logging.warning("Volume " + volume_id + " tagged by " + key + " " + value)
+    for volume_id, key, value, err in failed:
+        logging.error("Volume " + volume_id + " was not tagged by " + key + " " + value + ": " + err)
+    return tagged, failed
 
 
-def get_usertag(volume):
-    namespace = None
-    try:
-        for tag in ec2.Volume(id=volume).tags:
-            if tag['Key'] == 'kubernetes.io/created-for/pvc/namespace':
-                namespace = tag.get('Value')
-                logging.info("Namespace " + namespace + " for " + volume + " successfully retrieved")
-    except TypeError as terr:
-        logging.info("Cannot get namespace value for volume: " + volume + " " + str(terr))
-    if namespace:
-        for project in projects:
-            if re.match(project, namespace):
-                #user_tag = project
-                logging.info("Namespace " + namespace + " match to " + project + " project. User:tag " + project + " successfully retrieved")
-                return project
-            else:
-                logging.info("Namespace " + namespace + " didn't match to " + project + " project")
+def tag_volume(volume, user_tag):
+    return tag_volumes({(rules.target_tag, user_tag): [volume]})
+
 
+def get_usertag(volume, tags=None):
+    if tags is None:
+        tags = get_volume_tags([volume]).get(volume, {})
+    # the first rule of the rule set matching the tags gives the user:tag value
+    user_tag = rules.evaluate(tags)
+    if user_tag:
+        logging.info("User:tag " + user_tag + " for " + volume + " successfully retrieved")
     else:
-        logging.info('Volume ' + volume + ' has empty namespace tag')
-        return None
+        logging.info("Volume " + volume + " didn't match any tagging rule")
+    return user_tag
 
 
 # def get_volume_tag_dict():
@@ -153,7 +279,7 @@ def get_usertag(volume):
 def lambdaHandler(event, context):
     logging.warning("boto3 version:" + boto3.__version__)
     logging.warning("botocore version:" + botocore.__version__)
-    region = os.environ["AWS_REGION"]
+    region = getEnv("AWS_REGION")
     logging.warning ("AWS region:" + region)
 
     try:
@@ -161,11 +287,24 @@ def lambdaHandler(event, context):
     except ValueError as ex:
         logging.error(ex)
         sys.exit(1)
-    start_date_time = datetime.today() - timedelta(int(os.environ["IGNORE_WINDOW"]))
-    event_list = getCloudTrailEvents(start_date_time, region)
-    active_volumes = getRecentActiveVolumes(event_list)
+    now = datetime.now(timezone.utc)
+    start_date_time = now - timedelta(int(getEnv("IGNORE_WINDOW")))
+    cursor_time, cursor_ids = loadCursor()
+    backfill = isinstance(event, dict) and event.get('backfill', False)
+    if cursor_time and cursor_time - CURSOR_OVERLAP > start_date_time and not backfill:
+        # read only events after the cursor
+        event_list = getCloudTrailEvents(cursor_time - CURSOR_OVERLAP, region)
+    else:
+        event_list = backfillCloudTrailEvents(start_date_time, now, region,
+                                              int(os.environ.get("BACKFILL_SLICES", "1")))
+    # an explicit backfill processes the whole window again, already tagged
+    # volumes are skipped by validate_user_tag
+    new_events = event_list if backfill else getNewEvents(event_list, cursor_time, cursor_ids)
+    logging.info(str(len(new_events)) + " new CloudTrail events of " + str(len(event_list)) + " read")
+    active_volumes = getRecentActiveVolumes(new_events)
     # validate user:tag and tag if it doesn't exist
     validate_user_tag(active_volumes)
+    saveCursor(event_list, cursor_time, cursor_ids)
     # get list of available volumes
     # volume_tag_dict = get_volume_tag_dict()
     #
@@ -176,5 +315,42 @@ def lambdaHandler(event, context):
     #     logging.info("Mail successfully sent to subscription")
 
 
+def getEventVolumeId(event):
+    # volume ID of a CloudTrail CreateVolume/AttachVolume event or an EBS Volume Notification
+    detail = event.get('detail', {})
+    volume_id = (detail.get('responseElements') or {}).get('volumeId') \
+        or (detail.get('requestParameters') or {}).get('volumeId')
+    if volume_id:
+        return volume_id
+    for resource in event.get('resources', []):
+        if ':volume/' in resource:
+            return resource.split(':volume/')[-1]
+    return None
+
+
+def volumeEventHandler(event, context):
+    # EventBridge entry point, tags the single volume of the event
+    # tags are read again before writing, so duplicate deliveries change nothing
+    volume = getEventVolumeId(event)
+    if not volume:
+        logging.warning("Event without volume ID: " + json.dumps(event, default=str))
+        return {'volume': None, 'status': 'skipped'}
+    tags = get_volume_tags([volume]).get(volume)
+    if tags is None:
+        logging.warning("Volume " + volume + " not found")
+        return {'volume': volume, 'status': 'not_found'}
+    if rules.target_tag in tags:
+        logging.info("Volume " + volume + " has already been tagged by user:tag " + tags[rules.target_tag])
+        return {'volume': volume, 'status': 'already_tagged'}
+    user_tag = get_usertag(volume, tags)
+    if not user_tag:
+        logging.info("Volume " + str(volume) + " won't be tagged user:tag is empty")
+        return {'volume': volume, 'status': 'skipped'}
+    tagged, failed = tag_volume(volume, user_tag)
+    return {'volume': volume, 'status': 'tagged' if tagged else 'failed'}
+
+
 # if __name__ == '__main__':
 #     lambdaHandler(event=1, context=2)
+#     with open('shared-tag-volume-events/create_volume.json') as f:
+#         volumeEventHandler(event=json.load(f), context=2)
@@ -1,48 +1,46 @@
 import json
-import boto3
-import re
-from botocore.exceptions import ClientError
+import os
+from aws_clients import get_client
+from volume_tag_rules import VolumeTagRules, apply_plan
+from volume_shards import run_sharded
 
-# Tag map to tag volumes according to cluster name. Not applicable for Demo cluster
-tagMap = {
-    'kubernetes.io/cluster/eks-delivery':'delivery-eks',
-    'kubernetes.io/cluster/eks-demo':'demo-eks',
-    'kubernetes.io/cluster/delivery':'delivery',
-    'kubernetes.io/cluster/qa':'qa'
-}
+# Tagging rules are kept in volume_tag_rules.json. The cluster_map rule set
+# tags volumes according to cluster name, it is not applicable for Demo cluster
+rules = VolumeTagRules.from_file(os.environ.get('TAG_RULE_SET', 'tag_all_volumes'))
 
-projects = ["test1", "test2"]
+# Volumes with any tag key used by the rules, page by page
+def get_rule_volumes(ec2):
+    paginator = ec2.get_paginator('describe_volumes')
+    for page in paginator.paginate(
+            Filters=[{'Name': 'tag-key', 'Values': rules.filter_keys()}],
+            PaginationConfig={'PageSize': 500}):
+        for volume in page['Volumes']:
+            yield volume
 
-# Function for tagging volume with particular tag
-def tag_volume(volimeId, tagName, tagValue):
-                ec2res = boto3.resource('ec2')
-                volume = ec2res.Volume(volimeId)
-                try:
-                    tag = volume.create_tags(
-                        DryRun=False,
-                        Tags=[{'Key': tagName, 'Value': tagValue},])
-                except ClientError as e:
-                    print("Err - %s" % e)
+# Tagging plan of all volumes, listed once per run
+def plan_volumes():
+    ec2 = get_client('ec2', region_name='eu-central-1')
+    return rules.plan(get_rule_volumes(ec2))
 
-def lambda_handler(event, context):
-    ec2 = boto3.client('ec2', region_name='eu-central-1')
-    volumes = ec2.describe_volumes()
+# Tags the volumes of a plan, the whole plan or the part of one shard
+def tag_volumes(tagPlan):
+    ec2 = get_client('ec2', region_name='eu-central-1')
+    for (tagName, tagValue), volumeIds in tagPlan.items():
+        print("\nFound {} volumes without {} for {} project".format(len(volumeIds), tagName, tagValue))
+        print(", ".join(volumeIds))
+
+    tagged, failed = apply_plan(ec2, tagPlan)
+    for volumeId, tagName, tagValue, err in failed:
+        print("Err - %s - %s" % (volumeId, err))
+    print("\nTagged volumes: %d, failed: %d" % (len(tagged), len(failed)))
+    return {'tagged': len(tagged), 'failed': len(failed)}
 
-    for volume in volumes['Volumes']:
-        if 'Tags' in volume.keys():
-            if 'user:tag' not in [tags['Key'] for tags in volume['Tags']]:
-                print("\nFound volume without users:tag - %s" % volume['VolumeId'])
-                if 'kubernetes.io/created-for/pvc/namespace' in [tags['Key'] for tags in volume['Tags']]:
-                    for tag in volume['Tags']:
-                        if tag['Key'] == 'kubernetes.io/created-for/pvc/namespace':
-                            for project in projects:
-                                if re.match(project, tag['Value']):
-                                    print("Volume {} is for {} project".format(volume['VolumeId'],project))
-                                    tag_volume(volume['VolumeId'],'user:tag',project)
-                                else:
-                                    print("Unable to find match for: %s" % tag['Value'])
+# An event with "shards": N fans the sweep out to N concurrent invocations,
+# see volume_shards.py
+def lambda_handler(event, context):
+    result = run_sharded(event, context, plan_volumes, tag_volumes)
 
     return {
         'statusCode': 200,
-        'body': json.dumps('ОК')
+        'body': json.dumps('ОК' if 'status' not in result else result)
     }
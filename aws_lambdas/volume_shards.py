@@ -0,0 +1,223 @@
+import json
+import os
+import sqlite3
+import time
+import zlib
+
+from botocore.exceptions import ClientError
+
+from aws_clients import get_client
+
+# Sharded execution of the volume tagging Lambdas. A sweep is split into a
+# plan step, which lists the volumes and builds the tagging plan
+# {(key, value): [volume_id, ...]}, and an apply step, which tags them:
+#   - an event without "shards" plans and applies in one invocation
+#   - an event with "shards": N and no "shard" is a coordinator, it plans
+#     once, splits the plan into N shards by a stable hash of the volume ID
+#     and invokes the same function asynchronously with the plan of every
+#     shard in the event
+#   - an event with "shard": i is a worker, it takes the lease of its part
+#     and applies the plan of the event without listing volumes again
+# A shard plan larger than an asynchronous event allows is sent in several
+# parts, every part is a separate worker invocation.
+#
+# Leases are keyed by run ID, shard and part. A worker keeps the lease after a
+# successful sweep, so duplicate deliveries of the same asynchronous event
+# are skipped until it expires. A failed worker releases the lease and the
+# retry of the event can take it.
+#
+# environment variables:
+#   LEASE_TABLE -- DynamoDB table with the string partition key "lease"
+#                  (expires_at can be set as its TTL attribute), required for
+#                  sharded runs in Lambda
+#   LEASE_FILE  -- local SQLite lease store used without LEASE_TABLE outside
+#                  Lambda, it only coordinates invocations sharing a file
+#                  system (tests, local runs)
+
+LEASE_TTL = 900
+LEASE_FILE = os.path.join('/tmp', 'volume_shard_leases.sqlite')
+# Plan bytes per worker event, asynchronous invocations accept 256 KB
+MAX_PLAN_SIZE = 200000
+
+
+# crc32 is stable across processes unlike hash()
+def shard_index(volume_id, count):
+    return zlib.crc32(volume_id.encode()) % count
+
+
+class Shard:
+    def __init__(self, index, count):
+        if not 0 <= index < count:
+            raise ValueError('Shard ' + str(index) + ' is out of range for ' + str(count) + ' shards')
+        self.index = index
+        self.count = count
+
+    def owns(self, volume_id):
+        return shard_index(volume_id, self.count) == self.index
+
+
+class LocalLeaseStore:
+    def __init__(self, path=LEASE_FILE):
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS leases ('
+            'lease TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)')
+
+    def acquire(self, lease, owner, ttl):
+        now = time.time()
+        # one statement, so the check and the write are atomic across processes
+        with self.connection:
+            cursor = self.connection.execute(
+                'INSERT INTO leases VALUES (?, ?, ?) '
+                'ON CONFLICT(lease) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at '
+                'WHERE leases.expires_at < ? OR leases.owner = excluded.owner',
+                (lease, owner, now + ttl, now))
+        return cursor.rowcount == 1
+
+    def release(self, lease, owner):
+        with self.connection:
+            self.connection.execute(
+                'DELETE FROM leases WHERE lease = ? AND owner = ?', (lease, owner))
+
+
+class DynamoLeaseStore:
+    def __init__(self, table, client=None):
+        self.table = table
+        self.client = client or get_client('dynamodb')
+
+    def acquire(self, lease, owner, ttl):
+        now = int(time.time())
+        try:
+            self.client.put_item(
+                TableName=self.table,
+                Item={
+                    'lease': {'S': lease},
+                    'owner': {'S': owner},
+                    'expires_at': {'N': str(now + ttl)}
+                },
+                ConditionExpression='attribute_not_exists(lease) OR expires_at < :now OR #owner = :owner',
+                ExpressionAttributeNames={'#owner': 'owner'},
+                ExpressionAttributeValues={':now': {'N': str(now)}, ':owner': {'S': owner}})
+            return True
+        except ClientError as err:
+            if err.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+
+    def release(self, lease, owner):
+        try:
+            self.client.delete_item(
+                TableName=self.table,
+                Key={'lease': {'S': lease}},
+                ConditionExpression='#owner = :owner',
+                ExpressionAttributeNames={'#owner': 'owner'},
+                ExpressionAttributeValues={':owner': {'S': owner}})
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+
+def check_lease_table():
+    # the /tmp file of the local store is private to one Lambda execution
+    # environment, it would not keep two workers from running the same part
+    if not os.environ.get('LEASE_TABLE') and os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+        raise RuntimeError('LEASE_TABLE must be set for sharded runs in Lambda')
+
+
+def get_lease_store():
+    check_lease_table()
+    if os.environ.get('LEASE_TABLE'):
+        return DynamoLeaseStore(os.environ['LEASE_TABLE'])
+    return LocalLeaseStore(os.environ.get('LEASE_FILE', LEASE_FILE))
+
+
+def split_plan(tag_plan, shards):
+    # [plan of shard 0, ..., plan of shard N-1]
+    shard_plans = [{} for _ in range(shards)]
+    for (key, value), volume_ids in tag_plan.items():
+        for volume_id in volume_ids:
+            shard_plans[shard_index(volume_id, shards)].setdefault((key, value), []).append(volume_id)
+    return shard_plans
+
+
+def plan_parts(tag_plan, max_size=MAX_PLAN_SIZE):
+    # event form [[key, value, [volume_id, ...]], ...] of the plan, split
+    # into parts of at most max_size bytes of JSON
+    parts = [[]]
+    size = 0
+    for (key, value), volume_ids in tag_plan.items():
+        header = len(json.dumps([key, value, []])) + 2
+        entry = None
+        for volume_id in volume_ids:
+            item = len(json.dumps(volume_id)) + 2
+            if entry is None or size + item > max_size:
+                if size + header + item > max_size and parts[-1]:
+                    parts.append([])
+                    size = 0
+                entry = [key, value, []]
+                parts[-1].append(entry)
+                size += header
+            entry[2].append(volume_id)
+            size += item
+    return [part for part in parts if part]
+
+
+def decode_plan(items):
+    tag_plan = {}
+    for key, value, volume_ids in items:
+        tag_plan.setdefault((key, value), []).extend(volume_ids)
+    return tag_plan
+
+
+def fan_out(event, context, shards, tag_plan, lambda_client=None):
+    # invokes the function once per part of every shard plan, the workers
+    # run concurrently
+    lambda_client = lambda_client or get_client('lambda')
+    run_id = event.get('run_id') or context.aws_request_id
+    invocations = 0
+    for index, shard_plan in enumerate(split_plan(tag_plan, shards)):
+        for part, items in enumerate(plan_parts(shard_plan)):
+            payload = dict(event, shard=index, shards=shards, part=part, run_id=run_id, plan=items)
+            lambda_client.invoke(
+                FunctionName=context.invoked_function_arn,
+                InvocationType='Event',
+                Payload=json.dumps(payload))
+            invocations += 1
+    volumes = sum(len(volume_ids) for volume_ids in tag_plan.values())
+    print("Run " + run_id + " started " + str(invocations) + " workers for "
+          + str(volumes) + " volumes in " + str(shards) + " shards")
+    return {'run_id': run_id, 'shards': shards, 'workers': invocations, 'volumes': volumes, 'status': 'started'}
+
+
+def run_shard(event, context, apply, lease_store=None):
+    shard = Shard(int(event['shard']), int(event['shards']))
+    lease = event['run_id'] + '/' + str(shard.index) + '/' + str(event.get('part', 0))
+    owner = context.aws_request_id
+    lease_store = lease_store or get_lease_store()
+    ttl = LEASE_TTL
+    if hasattr(context, 'get_remaining_time_in_millis'):
+        ttl = context.get_remaining_time_in_millis() // 1000 + 60
+    if not lease_store.acquire(lease, owner, ttl):
+        print("Shard " + lease + " is leased by another worker")
+        return {'shard': shard.index, 'shards': shard.count, 'status': 'leased'}
+    try:
+        result = apply(decode_plan(event.get('plan', [])))
+    except Exception:
+        lease_store.release(lease, owner)
+        raise
+    print("Shard " + lease + " done")
+    return dict(result or {}, shard=shard.index, shards=shard.count, status='done')
+
+
+# plan() returns the tagging plan of the whole sweep, apply(tag_plan) tags
+# the volumes of a plan and returns a result dict
+def run_sharded(event, context, plan, apply, lease_store=None, lambda_client=None):
+    event = event if isinstance(event, dict) else {}
+    if 'shard' in event:
+        return run_shard(event, context, apply, lease_store)
+    shards = int(event.get('shards') or 1)
+    if shards > 1:
+        # fail before listing the volumes
+        check_lease_table()
+        return fan_out(event, context, shards, plan(), lambda_client)
+    return apply(plan())
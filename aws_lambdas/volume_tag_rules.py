@@ -0,0 +1,148 @@
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+# Rule engine shared by the volume tagging Lambdas. Rule sets are loaded from
+# volume_tag_rules.json (or TAG_RULES_FILE) and compiled once into:
+#   - a dict of tag keys for "tag_key" rules (volume has the key)
+#   - a dict of (key, value) pairs for "tag_value" rules (volume has key=value)
+#   - one combined regex per tag key for "tag_pattern" rules (re.match of the value)
+# A volume is evaluated with a few dict lookups and at most one regex match per
+# tag key, whatever the number of rules. When several rules match, the first
+# rule of the rule set wins. Volumes that already have the target tag are skipped.
+#
+# Rule fields:
+#   match         -- tag_key, tag_value or tag_pattern
+#   key           -- tag key the rule looks at
+#   value         -- tag value for tag_value rules
+#   pattern       -- regular expression matched at the start of the value for tag_pattern rules
+#   tag           -- value of the target tag set by the rule
+#   require_keys  -- optional list of tag keys the volume must also have
+
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'volume_tag_rules.json')
+# CreateTags accepts many resource IDs in one call
+TAG_BATCH_SIZE = 500
+MAX_WORKERS = 10
+
+
+class VolumeTagRules:
+    def __init__(self, rules, target_tag='user:tag'):
+        self.rules = rules
+        self.target_tag = target_tag
+        self.key_rules = {}
+        self.value_rules = {}
+        self.pattern_rules = {}
+        patterns = {}
+        for index, rule in enumerate(rules):
+            if rule['match'] == 'tag_key':
+                self.key_rules.setdefault(rule['key'], index)
+            elif rule['match'] == 'tag_value':
+                self.value_rules.setdefault((rule['key'], rule['value']), index)
+            elif rule['match'] == 'tag_pattern':
+                patterns.setdefault(rule['key'], []).append(index)
+            else:
+                raise ValueError('Unsupported rule match type: ' + str(rule['match']))
+        # one alternation per key, group names point back to the rule index
+        for key, indexes in patterns.items():
+            pattern = re.compile('|'.join(
+                '(?P<r{}>{})'.format(index, rules[index]['pattern']) for index in indexes))
+            singles = [(index, re.compile(rules[index]['pattern'])) for index in indexes]
+            # with require_keys the first matching rule may not apply, then the
+            # later rules of the key have to be checked one by one
+            fallback = any(rules[index].get('require_keys') for index in indexes)
+            self.pattern_rules[key] = (pattern, singles, fallback)
+
+    @classmethod
+    def from_file(cls, rule_set, path=None):
+        with open(path or os.environ.get('TAG_RULES_FILE', RULES_FILE)) as f:
+            config = json.load(f)
+        rule_set = config['rule_sets'][rule_set]
+        return cls(rule_set['rules'], rule_set.get('target_tag', 'user:tag'))
+
+    # tag keys the rules look at, for server side tag-key filters
+    def filter_keys(self):
+        keys = set(self.key_rules)
+        keys.update(key for key, _ in self.value_rules)
+        keys.update(self.pattern_rules)
+        return sorted(keys)
+
+    # indexes of the rules matching the tags of a volume
+    def matching_rules(self, tags):
+        indexes = []
+        for key, value in tags.items():
+            if key in self.key_rules:
+                indexes.append(self.key_rules[key])
+            if (key, value) in self.value_rules:
+                indexes.append(self.value_rules[(key, value)])
+            if key in self.pattern_rules:
+                pattern, singles, fallback = self.pattern_rules[key]
+                match = pattern.match(value)
+                if match:
+                    first = int(match.lastgroup[1:])
+                    indexes.append(first)
+                    if fallback:
+                        indexes += [index for index, single in singles
+                                    if index > first and single.match(value)]
+        return sorted(indexes)
+
+    # value of the target tag for a volume with tags {key: value}, None if
+    # the volume is already tagged or no rule matches
+    def evaluate(self, tags):
+        if self.target_tag in tags:
+            return None
+        for index in self.matching_rules(tags):
+            rule = self.rules[index]
+            if all(key in tags for key in rule.get('require_keys', [])):
+                return rule['tag']
+        return None
+
+    # one pass over describe_volumes items, grouped by (key, value)
+    def plan(self, volumes):
+        tag_plan = {}
+        for volume in volumes:
+            tags = {tag['Key']: tag['Value'] for tag in volume.get('Tags', [])}
+            value = self.evaluate(tags)
+            if value:
+                tag_plan.setdefault((self.target_tag, value), []).append(volume['VolumeId'])
+        return tag_plan
+
+
+def create_tags_batch(client, volume_ids, tags):
+    # tags a batch with one call, on failure falls back to one call per volume
+    try:
+        client.create_tags(Resources=volume_ids, Tags=tags)
+        return volume_ids, []
+    except ClientError as err:
+        if len(volume_ids) == 1:
+            return [], [(volume_ids[0], str(err))]
+    tagged = []
+    failed = []
+    for volume_id in volume_ids:
+        try:
+            client.create_tags(Resources=[volume_id], Tags=tags)
+            tagged.append(volume_id)
+        except ClientError as err:
+            failed.append((volume_id, str(err)))
+    return tagged, failed
+
+
+def apply_plan(client, tag_plan):
+    # applies a tagging plan {(key, value): [volume_id, ...]} with concurrent bulk calls
+    # returns lists of (volume_id, key, value) and (volume_id, key, value, error)
+    tagged = []
+    failed = []
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = []
+        for (key, value), volume_ids in tag_plan.items():
+            for i in range(0, len(volume_ids), TAG_BATCH_SIZE):
+                futures.append((key, value, executor.submit(
+                    create_tags_batch, client, volume_ids[i:i + TAG_BATCH_SIZE],
+                    [{'Key': key, 'Value': value}])))
+        for key, value, future in futures:
+            batch_tagged, batch_failed = future.result()
+            tagged += [(volume_id, key, value) for volume_id in batch_tagged]
+            failed += [(volume_id, key, value, err) for volume_id, err in batch_failed]
+    return tagged, failed